@@ -0,0 +1,456 @@
+""":mod:`benchmarks.run` --- Benchmark suite of ormeasy
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Measures :func:`ormeasy.sqlalchemy.test_connection`,
+:func:`ormeasy.asyncsqlalchemy.test_connection`,
+:func:`ormeasy.common.get_all_modules`,
+:func:`ormeasy.common.import_all_modules`,
+:func:`ormeasy.alembic.upgrade_database` and
+:func:`ormeasy.sqlalchemy.repr_entity` against synthetic metadata, package
+trees and revision chains of configurable size.  Everything runs offline;
+SQLite in a temporary directory is used unless ``--url`` points to
+a (local) PostgreSQL server.
+
+.. code-block:: console
+
+   $ python benchmarks/run.py --output baseline.json
+   $ python benchmarks/run.py --compare baseline.json
+
+Results are written as JSON, and ``--compare`` exits with status 1 if any
+benchmark got slower than ``--threshold`` relative to the baseline.
+
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import typing
+
+import alembic
+from alembic.config import Config
+import sqlalchemy
+from sqlalchemy import (Column, ForeignKey, Integer, MetaData, Table, Unicode,
+                        create_engine)
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import declarative_base
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ormeasy import __version__  # noqa: E402
+from ormeasy.alembic import upgrade_database  # noqa: E402
+from ormeasy.common import (clear_module_cache, get_all_modules,  # noqa: E402
+                            import_all_modules)
+from ormeasy.sqlalchemy import repr_entity, test_connection  # noqa: E402
+try:
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from ormeasy.asyncsqlalchemy import (  # noqa: E402
+        test_connection as async_test_connection
+    )
+except ImportError:
+    create_async_engine = None
+
+ENV_PY = '''
+from alembic import context
+from sqlalchemy import create_engine
+
+config = context.config
+engine = create_engine(config.get_main_option('sqlalchemy.url'))
+with engine.connect() as connection:
+    context.configure(connection=connection)
+    with context.begin_transaction():
+        context.run_migrations()
+engine.dispose()
+'''
+
+REVISION_PY = '''
+from alembic import op
+import sqlalchemy as sa
+
+revision = {revision!r}
+down_revision = {down_revision!r}
+
+
+def upgrade():
+    op.create_table(
+        {table!r},
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('name', sa.Unicode(64)),
+    )
+
+
+def downgrade():
+    op.drop_table({table!r})
+'''
+
+MODEL_PY = '''
+from sqlalchemy import Column, Integer, MetaData, Table
+
+metadata = MetaData()
+table = Table({table!r}, metadata, Column('id', Integer, primary_key=True))
+'''
+
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+}
+
+#: Registered benchmarks; see :func:`benchmark`.
+BENCHMARKS = {}
+
+
+def benchmark(name: str):
+    """Register a benchmark.  The decorated function takes the parsed options
+    and a temporary directory, and returns a callable to be timed,
+    or :const:`None` to skip it.  It may also be a generator which yields
+    the callable and cleans up afterwards.
+
+    """
+    def decorator(function):
+        BENCHMARKS[name] = function
+        return function
+    return decorator
+
+
+def make_metadata(tables: int, columns: int) -> MetaData:
+    """Build synthetic metadata of ``tables`` tables which have ``columns``
+    columns each.  Every table refers to the previous one.
+
+    """
+    metadata = MetaData()
+    for i in range(tables):
+        table_columns = [Column('id', Integer, primary_key=True)]
+        if i:
+            parent = ForeignKey('t{}.id'.format(i - 1))
+            table_columns.append(Column('parent_id', Integer, parent))
+        table_columns.extend(
+            Column('c{}'.format(j), Unicode(64))
+            for j in range(columns - len(table_columns))
+        )
+        Table('t{}'.format(i), metadata, *table_columns)
+    return metadata
+
+
+def make_package(directory: str, name: str, modules: int,
+                 depth: int = 3) -> None:
+    """Generate a package tree of ``modules`` modules spread over subpackages
+    nested ``depth`` levels deep.
+
+    """
+    packages = [os.path.join(directory, name)]
+    for level in range(1, depth):
+        packages.append(os.path.join(packages[-1], 'sub{}'.format(level)))
+    for package in packages:
+        os.makedirs(package)
+        open(os.path.join(package, '__init__.py'), 'w').close()
+    for i in range(modules):
+        package = packages[i % len(packages)]
+        with open(os.path.join(package, 'm{}.py'.format(i)), 'w') as f:
+            f.write(MODEL_PY.format(table='m{}'.format(i)))
+
+
+def make_migrations(directory: str, url: str, revisions: int) -> Config:
+    """Generate an Alembic script directory of a linear revision chain."""
+    script_dir = os.path.join(directory, 'migrations')
+    versions = os.path.join(script_dir, 'versions')
+    os.makedirs(versions)
+    with open(os.path.join(script_dir, 'env.py'), 'w') as f:
+        f.write(ENV_PY)
+    down_revision = None
+    for i in range(revisions):
+        revision = 'r{:04d}'.format(i)
+        with open(os.path.join(versions, revision + '.py'), 'w') as f:
+            f.write(REVISION_PY.format(revision=revision,
+                                       down_revision=down_revision,
+                                       table='migrated{}'.format(i)))
+        down_revision = revision
+    config = Config()
+    config.set_main_option('script_location', script_dir)
+    config.set_main_option('sqlalchemy.url', url)
+    return config
+
+
+def database_url(options, directory: str) -> str:
+    return options.url or 'sqlite:///' + os.path.join(directory, 'bench.db')
+
+
+def clear_database(engine) -> None:
+    metadata = MetaData()
+    metadata.reflect(engine)
+    metadata.drop_all(engine)
+
+
+class Context:
+    """Stands for the pytest ``request`` object."""
+
+
+@benchmark('test_connection')
+def bench_test_connection(options, directory):
+    metadata = make_metadata(options.tables, options.columns)
+    engine = create_engine(database_url(options, directory))
+
+    def run():
+        with test_connection(Context(), metadata, engine,
+                             dispose_engine=False):
+            pass
+    yield run
+    engine.dispose()
+
+
+@benchmark('test_connection_real_transaction')
+def bench_test_connection_real_transaction(options, directory):
+    metadata = make_metadata(options.tables, options.columns)
+    engine = create_engine(database_url(options, directory))
+
+    def run():
+        with test_connection(Context(), metadata, engine,
+                             real_transaction=True, dispose_engine=False):
+            pass
+    yield run
+    engine.dispose()
+
+
+def async_benchmark(real_transaction: bool):
+    def bench(options, directory):
+        url = make_url(database_url(options, directory))
+        driver = ASYNC_DRIVERS.get(url.get_backend_name())
+        if create_async_engine is None or driver is None:
+            return
+        metadata = make_metadata(options.tables, options.columns)
+        url = url.set(drivername=driver)
+        loop = asyncio.new_event_loop()
+        engine = create_async_engine(url)
+
+        async def run_async():
+            async with async_test_connection(
+                Context(), metadata, engine,
+                real_transaction=real_transaction, dispose_engine=False
+            ):
+                pass
+        try:
+            yield lambda: loop.run_until_complete(run_async())
+        finally:
+            loop.run_until_complete(engine.dispose())
+            loop.close()
+    return bench
+
+
+benchmark('async_test_connection')(async_benchmark(False))
+benchmark('async_test_connection_real_transaction')(async_benchmark(True))
+
+
+@contextlib.contextmanager
+def generated_package(options, directory):
+    name = 'benchpkg'
+    make_package(directory, name, options.modules)
+    sys.path.insert(0, directory)
+    try:
+        yield name
+    finally:
+        sys.path.remove(directory)
+        for module in list(sys.modules):
+            if module == name or module.startswith(name + '.'):
+                del sys.modules[module]
+
+
+@benchmark('get_all_modules')
+def bench_get_all_modules(options, directory):
+    with generated_package(options, directory) as name:
+        yield lambda: get_all_modules(name)
+
+
+@benchmark('get_all_modules_cached')
+def bench_get_all_modules_cached(options, directory):
+    with generated_package(options, directory) as name:
+        def run():
+            clear_module_cache()
+            get_all_modules(name, cache=True)
+        yield run
+
+
+@benchmark('import_all_modules')
+def bench_import_all_modules(options, directory):
+    with generated_package(options, directory) as name:
+        def run():
+            for module in list(sys.modules):
+                if module.startswith(name + '.'):
+                    del sys.modules[module]
+            import_all_modules(name)
+        yield run
+
+
+@benchmark('upgrade_database')
+def bench_upgrade_database(options, directory):
+    url = database_url(options, directory)
+    config = make_migrations(directory, url, options.revisions)
+    engine = create_engine(url)
+    head = 'r{:04d}'.format(options.revisions - 1)
+
+    def run():
+        clear_database(engine)
+        upgrade_database(config, engine, MetaData(), revision=head)
+    yield run
+    clear_database(engine)
+    engine.dispose()
+
+
+@benchmark('upgrade_database_bootstrap')
+def bench_upgrade_database_bootstrap(options, directory):
+    url = database_url(options, directory)
+    config = make_migrations(directory, url, options.revisions)
+    metadata = make_metadata(options.tables, options.columns)
+    engine = create_engine(url)
+
+    def run():
+        clear_database(engine)
+        upgrade_database(config, engine, metadata)
+    yield run
+    clear_database(engine)
+    engine.dispose()
+
+
+@benchmark('repr_entity')
+def bench_repr_entity(options, directory):
+    Base = declarative_base(metadata=make_metadata(1, options.columns))
+
+    class Entity(Base):
+        __table__ = Base.metadata.tables['t0']
+
+    names = [c.name for c in Entity.__table__.columns]
+    entities = [
+        Entity(**{name: str(i) if name.startswith('c') else i
+                  for name in names})
+        for i in range(options.entities)
+    ]
+
+    def run():
+        for entity in entities:
+            repr_entity(entity)
+    return run
+
+
+def measure(function: typing.Callable[[], None],
+            repeat: int) -> typing.Sequence[float]:
+    function()  # warm up
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def run_benchmark(name: str, options) -> typing.Optional[dict]:
+    directory = tempfile.mkdtemp(prefix='ormeasy-bench-')
+    try:
+        setup = BENCHMARKS[name](options, directory)
+        if setup is None or callable(setup):
+            function, cleanup = setup, None
+        else:
+            function, cleanup = next(setup, None), setup
+        try:
+            if function is None:
+                return None
+            timings = measure(function, options.repeat)
+        finally:
+            if cleanup is not None:
+                for _ in cleanup:
+                    pass
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return {
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'max': max(timings),
+        'runs': timings,
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    """Print the ratio of medians against the ``baseline``, and return
+    whether nothing got slower than ``threshold``.
+
+    """
+    ok = True
+    print('\n{:<40} {:>12} {:>12} {:>8}'.format('benchmark', 'baseline',
+                                                'current', 'ratio'))
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        ratio = result['median'] / base['median']
+        regressed = ratio > 1 + threshold
+        ok = ok and not regressed
+        print('{:<40} {:>12.6f} {:>12.6f} {:>7.2f}x{}'.format(
+            name, base['median'], result['median'], ratio,
+            ' REGRESSED' if regressed else ''
+        ))
+    return ok
+
+
+def main(argv: typing.Optional[typing.Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('names', nargs='*', metavar='BENCHMARK',
+                        help='benchmarks to run (default: all of {})'.format(
+                            ', '.join(BENCHMARKS)
+                        ))
+    parser.add_argument('--url', help='database URL (default: a temporary '
+                                      'SQLite file)')
+    parser.add_argument('--tables', type=int, default=50)
+    parser.add_argument('--columns', type=int, default=10)
+    parser.add_argument('--modules', type=int, default=200)
+    parser.add_argument('--revisions', type=int, default=50)
+    parser.add_argument('--entities', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', '-o', help='file to store results in')
+    parser.add_argument('--compare', '-c', metavar='BASELINE',
+                        help='results file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='tolerated slowdown ratio (default: 0.1)')
+    options = parser.parse_args(argv)
+    unknown = set(options.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: ' + ', '.join(sorted(unknown)))
+    results = {}
+    for name in options.names or BENCHMARKS:
+        result = run_benchmark(name, options)
+        if result is None:
+            print('{:<40} {:>12}'.format(name, 'skipped'))
+            continue
+        results[name] = result
+        print('{:<40} {:>12.6f}'.format(name, result['median']))
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({
+                'environment': {
+                    'python': platform.python_version(),
+                    'sqlalchemy': sqlalchemy.__version__,
+                    'alembic': alembic.__version__,
+                    'ormeasy': __version__,
+                    'dialect': make_url(
+                        database_url(options, '')
+                    ).get_backend_name(),
+                },
+                'parameters': {
+                    key: getattr(options, key)
+                    for key in ('tables', 'columns', 'modules', 'revisions',
+                                'entities', 'repeat')
+                },
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)['results']
+        if not compare(results, baseline, options.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
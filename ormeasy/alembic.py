@@ -2,18 +2,32 @@
 ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 """
+import concurrent.futures
+import contextlib
+import copy
+import json
+import os
+import threading
+import time
 import typing
 
 from alembic.config import Config
 from alembic.environment import EnvironmentContext
+from alembic.migration import MigrationContext
 from alembic.script import ScriptDirectory
-from sqlalchemy.engine import Engine
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.event import listen, remove
 from sqlalchemy.schema import MetaData
-from sqlalchemy.sql.expression import literal_column
+from sqlalchemy.sql.expression import literal_column, text
 
 from .common import import_all_modules
+from .sqlalchemy import _fingerprint_metadata
 
-__all__ = 'upgrade_database',
+__all__ = (
+    'MigrationStep', 'SchemaDrift', 'UpgradeResult', 'check_schema',
+    'upgrade_database', 'upgrade_databases',
+)
 
 
 def upgrade_database(
@@ -23,14 +37,441 @@ def upgrade_database(
     *,
     revision: str = 'head',
     module_name: typing.Optional[str] = None,
+    offline: bool = False,
+    chunk_size: typing.Optional[int] = None,
+    ddl_snapshot: bool = False,
+    ddl_cache_dir: typing.Optional[str] = None,
+    on_step: typing.Optional[typing.Callable[['MigrationStep'], None]] = None,
+    lock_timeout: typing.Optional[int] = None,
+    statement_timeout: typing.Optional[int] = None,
 ) -> None:
     """Upgrades the database schema to the chosen ``revision`` (default is
     head).
 
+    The parsed script directory is kept in the process until any file in it
+    changes, so that repeated upgrades don't parse revision scripts again.
+
+    :param bool offline: (Optional) Generate the SQL of the whole upgrade
+                         in offline mode (like ``alembic upgrade --sql``)
+                         first, including version table updates, and run it
+                         as a batched script in a single transaction.
+                         The generated SQL is cached in the process for
+                         the same from/to revisions until any revision
+                         script changes.  ``env.py`` has to support offline
+                         mode, and render the SQL for the engine's dialect,
+                         which is passed as
+                         ``config.attributes['dialect_name']``::
+
+                             context.configure(
+                                 dialect_name=config.attributes.get(
+                                     'dialect_name'
+                                 ),
+                                 literal_binds=True,
+                             )
+
+                         Default: `False`
+    :param int or None chunk_size: (Optional) The number of statements sent
+                                   at once in ``offline`` mode.  The whole
+                                   script is sent at once by default.
+                                   SQLite can run only one statement at once,
+                                   so it's always 1 there.
+    :param bool ddl_snapshot: (Optional) When the database is empty and
+                              ``revision`` is head, run the DDL of
+                              ``metadata`` compiled in advance as a batched
+                              script in a single transaction, instead of
+                              :meth:`MetaData.create_all()
+                              <sqlalchemy.schema.MetaData.create_all>`.
+                              The compiled DDL is cached by the fingerprint
+                              of ``metadata``, the dialect and the server
+                              version.
+                              Default: `False`
+    :param str or None ddl_cache_dir: (Optional) The directory to store
+                                      the compiled DDL as ``.json`` files,
+                                      so that it can be shared by processes.
+                                      Implies ``ddl_snapshot``.
+    :param on_step: (Optional) A function called with :class:`MigrationStep`
+                    after each revision is applied, e.g. for logging slow
+                    revisions.  It can't be combined with ``offline``,
+                    since the generated script runs as a whole.
+    :param int or None lock_timeout: (Optional) PostgreSQL ``lock_timeout``
+                                     in milliseconds applied to every
+                                     migration transaction (including
+                                     ``offline`` scripts and the schema
+                                     creation of empty databases), so that
+                                     a migration blocked by a lock fails fast
+                                     instead of stalling other queries.
+    :param int or None statement_timeout: (Optional) PostgreSQL
+                                          ``statement_timeout`` in
+                                          milliseconds applied like
+                                          ``lock_timeout``.
+
     """
+    _upgrade(config, _script_directory(config), engine, metadata,
+             revision=revision, module_name=module_name, offline=offline,
+             chunk_size=chunk_size, ddl_snapshot=ddl_snapshot,
+             ddl_cache_dir=ddl_cache_dir, on_step=on_step,
+             lock_timeout=lock_timeout, statement_timeout=statement_timeout)
+
+
+def upgrade_databases(
+    config: Config,
+    engines: typing.Iterable[Engine],
+    metadata: MetaData,
+    *,
+    revision: str = 'head',
+    module_name: typing.Optional[str] = None,
+    max_workers: typing.Optional[int] = None,
+    stop_on_error: bool = False,
+    progress: typing.Optional[typing.Callable[['UpgradeResult'], None]] = None,
+    **options
+) -> typing.Sequence['UpgradeResult']:
+    """Upgrades the schemas of many databases (e.g. one per tenant) to
+    the chosen ``revision`` using a thread pool.  The script directory is
+    parsed at most once, and databases which are already at ``revision`` are
+    skipped without running ``env.py``.
+
+    Since ``env.py`` has to know which database to migrate, the connection
+    is passed through ``config.attributes['connection']`` as alembic's
+    cookbook recommends::
+
+        connection = config.attributes.get('connection')
+        if connection is None:
+            ...  # connect as usual
+        context.configure(connection=connection, ...)
+
+    alembic's ``context`` and ``op`` proxies are global to the process,
+    so the migration scripts themselves run one database at a time, while
+    connecting and checking revisions run concurrently.
+
+    :param Config config: alembic configuration
+    :param engines: Engines of the databases to upgrade.  Use
+                    :meth:`Engine.execution_options()
+                    <sqlalchemy.engine.Engine.execution_options>` with
+                    ``schema_translate_map`` to upgrade schemas of the same
+                    database.
+    :param MetaData metadata: SQLAlchemy schema metadata
+    :param str revision: (Optional) The revision to upgrade to.
+                         Default: `'head'`
+    :param str or None module_name: (Optional) See :func:`upgrade_database`.
+    :param int or None max_workers: (Optional) The number of threads.
+    :param bool stop_on_error: (Optional) Don't start upgrading more
+                               databases after the first failure, and raise
+                               the error.  Default: `False`
+    :param progress: (Optional) A function called with each
+                     :class:`UpgradeResult` as soon as a database is done.
+    :return: :class:`UpgradeResult` for each of ``engines`` in order.
+
+    Other keyword arguments are passed to :func:`upgrade_database`.
+
+    """
+    script = _script_directory(config)
+    dest = script.get_revision(revision)
+    dest = dest and dest.revision
+
+    def run(engine):
+        start = time.perf_counter()
+        waited = 0.0
+        before = after = None
+        try:
+            with engine.connect() as connection:
+                before = after = MigrationContext.configure(
+                    connection
+                ).get_current_revision()
+                if before != dest:
+                    # Otherwise alembic regards the transaction autobegun by
+                    # the probe on a future engine as an external one, and
+                    # leaves it uncommitted.
+                    if connection.in_transaction():
+                        connection.rollback()
+                    wait_start = time.perf_counter()
+                    with _environment_lock:
+                        waited = time.perf_counter() - wait_start
+                        _upgrade(_connection_config(config, connection),
+                                 script, engine, metadata,
+                                 revision=revision, module_name=module_name,
+                                 **options)
+                    if connection.in_transaction():
+                        connection.commit()
+                    after = MigrationContext.configure(
+                        connection
+                    ).get_current_revision()
+        except Exception as e:
+            return UpgradeResult(engine, before, after,
+                                 time.perf_counter() - start - waited, e)
+        return UpgradeResult(engine, before, after,
+                             time.perf_counter() - start - waited, None)
+    engines = list(engines)
+    results = [None] * len(engines)
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        futures = {executor.submit(run, engine): i
+                   for i, engine in enumerate(engines)}
+        for future in concurrent.futures.as_completed(futures):
+            result = results[futures[future]] = future.result()
+            if progress is not None:
+                progress(result)
+            if result.error is not None and stop_on_error:
+                for f in futures:
+                    f.cancel()
+                raise result.error
+    return results
+
+
+#: The result of upgrading a database by :func:`upgrade_databases`.
+#: ``before`` and ``after`` are the revisions, ``elapsed`` is in seconds
+#: excluding the time spent waiting for other databases to be migrated, and
+#: ``error`` is the exception raised while upgrading, if any.
+UpgradeResult = typing.NamedTuple('UpgradeResult', [
+    ('engine', Engine),
+    ('before', typing.Optional[str]),
+    ('after', typing.Optional[str]),
+    ('elapsed', float),
+    ('error', typing.Optional[BaseException]),
+])
+
+
+class SchemaDrift(typing.NamedTuple('SchemaDrift', [
+    ('current_heads', typing.Tuple[str, ...]),
+    ('heads', typing.Tuple[str, ...]),
+    ('missing_tables', typing.Tuple[str, ...]),
+    ('unexpected_tables', typing.Tuple[str, ...]),
+    ('missing_columns', typing.Tuple[typing.Tuple[str, str], ...]),
+    ('unexpected_columns', typing.Tuple[typing.Tuple[str, str], ...]),
+])):
+    """The difference between a live database and its expected schema,
+    found by :func:`check_schema`.  ``current_heads`` are the revisions of
+    the database and ``heads`` are the ones of the script directory.
+    Tables and columns are compared by name, and columns are
+    ``(table, column)`` pairs.
+
+    """
+
+    __slots__ = ()
+
+    @property
+    def drifted(self) -> bool:
+        """Whether the database differs from the expected schema."""
+        return (set(self.current_heads) != set(self.heads) or
+                any(self[2:]))
+
+
+def check_schema(
+    config: Config,
+    engine: Engine,
+    metadata: MetaData,
+    *,
+    module_name: typing.Optional[str] = None,
+    version_table: str = 'alembic_version',
+) -> SchemaDrift:
+    """Compare the live database against ``metadata`` and the head revisions,
+    e.g. to refuse to start with an incompatible schema.  The schema is read
+    in a single catalog query on PostgreSQL, MySQL and SQLite (3.16+),
+    so it is cheap enough to run on every start.  Other databases are
+    inspected per table.  Only the tables in the default schema are compared.
+
+    .. code-block::
+
+       drift = check_schema(config, engine, Base.metadata,
+                            module_name='myapp.models')
+       if drift.drifted:
+           raise SystemExit('schema drifted: {!r}'.format(drift))
+
+    :param Config config: alembic config
+    :param engine: the database to check
+    :param MetaData metadata: SQLAlchemy schema metadata
+    :param str module_name: (Optional) The package to import all modules of
+                            first, to define all tables
+    :param str version_table: (Optional) The alembic version table, which
+                              is ignored.  Default: `'alembic_version'`
+    :return: the difference
+    :rtype: :class:`SchemaDrift`
+
+    """
+    if module_name:
+        import_all_modules(module_name)
+    script = _script_directory(config)
+    with engine.connect() as connection:
+        return _check_schema(connection, script, metadata, version_table)
+
+
+#: The queries of (table name, column name) pairs of the tables (but not
+#: views, like :meth:`Inspector.get_table_names()
+#: <sqlalchemy.engine.reflection.Inspector.get_table_names>`) in the default
+#: schema by dialect.
+_column_queries = {
+    'postgresql': '''
+        SELECT c.relname, a.attname
+        FROM pg_catalog.pg_class AS c
+        JOIN pg_catalog.pg_namespace AS n
+          ON n.oid = c.relnamespace AND n.nspname = current_schema()
+        JOIN pg_catalog.pg_attribute AS a ON a.attrelid = c.oid
+        WHERE c.relkind IN ('r', 'p')
+          AND a.attnum > 0 AND NOT a.attisdropped
+    ''',
+    'mysql': '''
+        SELECT c.table_name, c.column_name
+        FROM information_schema.columns AS c
+        JOIN information_schema.tables AS t
+          ON t.table_schema = c.table_schema AND t.table_name = c.table_name
+        WHERE c.table_schema = DATABASE() AND t.table_type = 'BASE TABLE'
+    ''',
+    'sqlite': r'''
+        SELECT m.name, p.name
+        FROM sqlite_master AS m JOIN pragma_table_info(m.name) AS p
+        WHERE m.type = 'table' AND m.name NOT LIKE 'sqlite\_%' ESCAPE '\'
+    ''',
+}
+_column_queries['mariadb'] = _column_queries['mysql']
+
+
+def _check_schema(
+    connection: Connection,
+    script: ScriptDirectory,
+    metadata: MetaData,
+    version_table: str,
+) -> SchemaDrift:
+    current_heads = MigrationContext.configure(
+        connection, opts={'version_table': version_table}
+    ).get_current_heads()
+    actual = _reflect_columns(connection)
+    actual.pop(version_table, None)
+    expected = {
+        table.name: {column.name for column in table.columns}
+        for table in metadata.tables.values()
+        if table.schema is None
+    }
+    missing_columns = []
+    unexpected_columns = []
+    for name in sorted(set(expected) & set(actual)):
+        missing_columns.extend(
+            (name, column) for column in sorted(expected[name] - actual[name])
+        )
+        unexpected_columns.extend(
+            (name, column) for column in sorted(actual[name] - expected[name])
+        )
+    return SchemaDrift(
+        current_heads=tuple(sorted(current_heads)),
+        heads=tuple(sorted(script.get_heads())),
+        missing_tables=tuple(sorted(set(expected) - set(actual))),
+        unexpected_tables=tuple(sorted(set(actual) - set(expected))),
+        missing_columns=tuple(missing_columns),
+        unexpected_columns=tuple(unexpected_columns),
+    )
+
+
+def _reflect_columns(
+    connection: Connection,
+) -> typing.Dict[str, typing.Set[str]]:
+    query = _column_queries.get(connection.dialect.name)
+    if query is None:
+        inspector = inspect(connection)
+        return {
+            table: {column['name'] for column in inspector.get_columns(table)}
+            for table in inspector.get_table_names()
+        }
+    columns = {}
+    for table, column in connection.execute(text(query)):
+        columns.setdefault(table, set()).add(column)
+    return columns
+
+
+#: The parsed script directories, keyed by the script location and
+#: version locations, with the signature made by :func:`_script_signature`.
+_scripts = {}
+_scripts_lock = threading.Lock()
+
+#: alembic's proxies (``alembic.context`` and ``alembic.op``) are global,
+#: so only one migration environment can run at a time.
+_environment_lock = threading.Lock()
+
+
+def _script_signature(
+    script: ScriptDirectory,
+) -> typing.FrozenSet[typing.Tuple[str, int, int]]:
+    signature = set()
+    for location in [script.dir] + list(script.version_locations or ()):
+        for dirpath, dirnames, filenames in os.walk(location):
+            if '__pycache__' in dirnames:
+                dirnames.remove('__pycache__')
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                signature.add((path, stat.st_mtime_ns, stat.st_size))
+    return frozenset(signature)
+
+
+def _script_directory(config: Config) -> ScriptDirectory:
     script = ScriptDirectory.from_config(config)
+    key = script.dir, tuple(script.version_locations or ())
+    signature = _script_signature(script)
+    with _scripts_lock:
+        cached = _scripts.get(key)
+        if cached is not None and cached[1] == signature:
+            return cached[0]
+        # Parsing revision scripts is deferred until the revision map is
+        # used for the first time.
+        script.get_heads()
+        _scripts[key] = script, signature
+        if cached is not None:
+            # SQL generated from the old revisions is stale.
+            for offline_key in list(_offline_sql):
+                if offline_key[0] == script.dir:
+                    del _offline_sql[offline_key]
+    return script
+
+
+def _connection_config(config: Config, connection: Connection) -> Config:
+    # A copy of config which passes connection to env.py, because env.py is
+    # run for many connections at once.
+    connection_config = copy.copy(config)
+    connection_config.attributes = dict(config.attributes,
+                                        connection=connection)
+    return connection_config
+
+
+def _upgrade(
+    config: Config,
+    script: ScriptDirectory,
+    engine: Engine,
+    metadata: MetaData,
+    *,
+    revision: str = 'head',
+    module_name: typing.Optional[str] = None,
+    offline: bool = False,
+    chunk_size: typing.Optional[int] = None,
+    ddl_snapshot: bool = False,
+    ddl_cache_dir: typing.Optional[str] = None,
+    on_step: typing.Optional[typing.Callable[['MigrationStep'], None]] = None,
+    lock_timeout: typing.Optional[int] = None,
+    statement_timeout: typing.Optional[int] = None,
+) -> None:
+    if offline and on_step is not None:
+        raise ValueError('on_step cannot be combined with offline')
+    if offline:
+        with engine.connect() as connection:
+            current_rev = MigrationContext.configure(
+                connection
+            ).get_current_revision()
+        if current_rev is not None:
+            dest = script.get_revision(revision)
+            statements = _generate_sql(config, script, engine.dialect.name,
+                                       current_rev, dest and dest.revision)
+            with engine.begin() as connection, \
+                    _timeouts(connection, lock_timeout, statement_timeout):
+                _execute_script(connection, statements, chunk_size)
+            return
+
+    cleanups = []
 
     def upgrade(rev, context):
+        if lock_timeout or statement_timeout:
+            cleanups.append(_set_timeouts(context.connection, lock_timeout,
+                                          statement_timeout))
+        if on_step is not None:
+            cleanups.append(_instrument(context, on_step))
+
         def update_current_rev(old, new):
             if old == new:
                 return
@@ -52,11 +493,261 @@ def upgrade_database(
         if not rev and revision == 'head':
             if module_name:
                 import_all_modules(module_name)
-            metadata.create_all(engine)
+            with engine.begin() as connection, \
+                    _timeouts(connection, lock_timeout, statement_timeout):
+                if ddl_snapshot or ddl_cache_dir:
+                    _execute_script(connection, _compile_ddl(metadata, engine,
+                                                             ddl_cache_dir))
+                else:
+                    metadata.create_all(connection)
             dest = script.get_revision(revision)
             update_current_rev(None, dest and dest.revision)
             return []
         return script._upgrade_revs(revision, rev)
-    with EnvironmentContext(config, script, fn=upgrade, as_sql=False,
-                            destination_rev=revision, tag=None):
+    try:
+        with EnvironmentContext(config, script, fn=upgrade, as_sql=False,
+                                destination_rev=revision, tag=None):
+            script.run_env()
+    finally:
+        for cleanup in cleanups:
+            cleanup()
+
+
+#: The statistics of a revision applied by :func:`upgrade_database`.
+#: ``elapsed`` is the wall time and ``database_time`` is the time spent on
+#: executing ``statements``, in seconds.
+MigrationStep = typing.NamedTuple('MigrationStep', [
+    ('source', typing.Tuple[str, ...]),
+    ('destination', typing.Tuple[str, ...]),
+    ('elapsed', float),
+    ('database_time', float),
+    ('statements', typing.Sequence[str]),
+])
+
+
+def _instrument(
+    context: MigrationContext,
+    on_step: typing.Callable[[MigrationStep], None],
+) -> typing.Callable[[], None]:
+    connection = context.connection
+    statements = []
+    timer = [time.perf_counter(), 0.0]  # step start, database time
+    starts = {}
+
+    def before_cursor_execute(conn, cursor, statement, parameters,
+                              execution_context, executemany):
+        starts[id(execution_context)] = time.perf_counter()
+
+    def after_cursor_execute(conn, cursor, statement, parameters,
+                             execution_context, executemany):
+        start = starts.pop(id(execution_context), None)
+        if start is None:
+            return
+        timer[1] += time.perf_counter() - start
+        statements.append(statement)
+
+    def on_version_apply(ctx, step, heads, run_args):
+        now = time.perf_counter()
+        on_step(MigrationStep(
+            tuple(step.source_revision_ids),
+            tuple(step.destination_revision_ids),
+            now - timer[0],
+            timer[1],
+            list(statements),
+        ))
+        timer[:] = now, 0.0
+        del statements[:]
+
+    listen(connection, 'before_cursor_execute', before_cursor_execute)
+    listen(connection, 'after_cursor_execute', after_cursor_execute)
+    context.on_version_apply_callbacks += (on_version_apply,)
+
+    def cleanup():
+        remove(connection, 'before_cursor_execute', before_cursor_execute)
+        remove(connection, 'after_cursor_execute', after_cursor_execute)
+    return cleanup
+
+
+def _set_timeouts(
+    connection: Connection,
+    lock_timeout: typing.Optional[int],
+    statement_timeout: typing.Optional[int],
+) -> typing.Callable[[], None]:
+    if connection.dialect.name != 'postgresql':
+        raise ValueError(
+            'lock_timeout and statement_timeout are not supported on '
+            '{!s}'.format(connection.dialect.name)
+        )
+    statement = ' '.join(
+        'SET LOCAL {!s} = {:d};'.format(name, value)
+        for name, value in [('lock_timeout', lock_timeout),
+                            ('statement_timeout', statement_timeout)]
+        if value
+    )
+
+    def begin(conn):
+        # SET LOCAL lasts until the end of the transaction, so it has to be
+        # set again for every transaction (e.g. transaction_per_migration).
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute(statement)
+        finally:
+            cursor.close()
+
+    if connection.in_transaction():
+        begin(connection)
+    listen(connection, 'begin', begin)
+    return lambda: remove(connection, 'begin', begin)
+
+
+@contextlib.contextmanager
+def _timeouts(
+    connection: Connection,
+    lock_timeout: typing.Optional[int],
+    statement_timeout: typing.Optional[int],
+) -> typing.Generator:
+    if not (lock_timeout or statement_timeout):
+        yield
+        return
+    cleanup = _set_timeouts(connection, lock_timeout, statement_timeout)
+    try:
+        yield
+    finally:
+        cleanup()
+
+
+#: The SQL generated by :func:`upgrade_database` in offline mode, keyed by
+#: the script directory, the dialect name, and the from/to revisions.
+#: Entries of a script directory are dropped by :func:`_script_directory`
+#: when it parses the directory again.
+_offline_sql = {}
+
+
+class _StatementBuffer:
+    """Output buffer of offline mode, which alembic writes each statement
+    into at once.
+
+    """
+
+    def __init__(self):
+        self.statements = []
+
+    def write(self, text: str) -> None:
+        text = text.strip()
+        # Only alembic's own one-line comments (e.g. -- Running upgrade) are
+        # skipped; a statement can start with a comment line too.
+        if not text or (text.startswith('--') and '\n' not in text) or \
+           text.upper() in ('BEGIN;', 'COMMIT;'):
+            return
+        self.statements.append(text)
+
+    def flush(self) -> None:
+        pass
+
+
+def _generate_sql(
+    config: Config,
+    script: ScriptDirectory,
+    dialect_name: str,
+    starting_rev: str,
+    destination_rev: typing.Optional[str],
+) -> typing.Sequence[str]:
+    key = script.dir, dialect_name, starting_rev, destination_rev
+    try:
+        return _offline_sql[key]
+    except KeyError:
+        pass
+    buffer = _StatementBuffer()
+    rendered = []
+    offline_config = copy.copy(config)
+    offline_config.attributes = dict(config.attributes,
+                                     dialect_name=dialect_name)
+
+    def upgrade(rev, context):
+        rendered.append(context.dialect.name)
+        return script._upgrade_revs(destination_rev, rev)
+    with EnvironmentContext(offline_config, script, fn=upgrade, as_sql=True,
+                            starting_rev=starting_rev,
+                            destination_rev=destination_rev,
+                            output_buffer=buffer, tag=None):
         script.run_env()
+    if rendered and rendered[0] != dialect_name:
+        raise ValueError(
+            'env.py rendered the SQL for {!s} instead of {!s}; configure it '
+            "with dialect_name=config.attributes['dialect_name']".format(
+                rendered[0], dialect_name
+            )
+        )
+    _offline_sql[key] = buffer.statements
+    return buffer.statements
+
+
+def _execute_script(
+    connection: Connection,
+    statements: typing.Sequence[str],
+    chunk_size: typing.Optional[int] = None,
+) -> None:
+    if connection.dialect.name == 'sqlite':
+        chunk_size = 1
+    elif not chunk_size:
+        chunk_size = max(len(statements), 1)
+    # SQLAlchemy < 1.4 has no Connection.exec_driver_sql()
+    execute = getattr(connection, 'exec_driver_sql', connection.execute)
+    for i in range(0, len(statements), chunk_size):
+        execute('\n'.join(statements[i:i + chunk_size]))
+
+
+#: The DDL compiled by :func:`upgrade_database` with ``ddl_snapshot``, keyed
+#: by the fingerprint made by :func:`.sqlalchemy._fingerprint_metadata`.
+_ddl_snapshots = {}
+
+
+def _compile_ddl(
+    metadata: MetaData,
+    engine: Engine,
+    cache_dir: typing.Optional[str] = None,
+) -> typing.Sequence[str]:
+    dialect = engine.dialect
+    # The DDL is compiled by the dialect of the engine, which knows the
+    # server version once connected and can render differently for it,
+    # so the version has to be part of the fingerprint.
+    version = '.'.join(map(str, dialect.server_version_info or ()))
+    fingerprint = _fingerprint_metadata(metadata,
+                                        '{} {}'.format(dialect.name, version))
+    try:
+        return _ddl_snapshots[fingerprint]
+    except KeyError:
+        pass
+    if cache_dir:
+        filename = os.path.join(cache_dir, fingerprint + '.json')
+        try:
+            with open(filename) as f:
+                statements = json.load(f)
+        except (OSError, ValueError):
+            pass
+        else:
+            _ddl_snapshots[fingerprint] = statements
+            return statements
+    statements = []
+
+    def executor(sql, *multiparams, **params):
+        # Terminated, since statements run as a single script except SQLite
+        statements.append(str(sql.compile(dialect=dialect)).strip() + ';')
+    try:
+        from sqlalchemy import create_mock_engine
+    except ImportError:
+        # SQLAlchemy < 1.4
+        mock = create_engine(engine.url, strategy='mock', executor=executor)
+    else:
+        mock = create_mock_engine(engine.url, executor)
+    metadata.create_all(mock, checkfirst=False)
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        temp = '{!s}.{!s}'.format(filename, os.getpid())
+        # A list of statements, since a statement can contain any separator
+        # (e.g. in comments or defaults).
+        with open(temp, 'w') as f:
+            json.dump(statements, f, indent=0)
+        os.replace(temp, filename)
+    _ddl_snapshots[fingerprint] = statements
+    return statements
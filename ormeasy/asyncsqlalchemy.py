@@ -1,27 +1,171 @@
+import asyncio
+import collections.abc
 import contextlib
+import os
 import sys
+import time
+import typing
 
+from alembic.config import Config
+from alembic.migration import MigrationContext
+from sqlalchemy.engine.url import URL
 from sqlalchemy.schema import MetaData
 try:
-    from sqlalchemy.ext.asyncio import create_async_engine
+    from sqlalchemy.ext.asyncio import (AsyncEngine, AsyncSession,
+                                        async_engine_from_config,
+                                        create_async_engine)
+    from sqlalchemy.pool import AsyncAdaptedQueuePool
 except ImportError:
     create_async_engine = None
 
+from .alembic import (SchemaDrift, UpgradeResult, _check_schema,
+                      _connection_config, _script_directory, _upgrade)
+from .common import import_all_modules
+from .sqlalchemy import (Fixtures, HotStatement, Router, RoutingSession,
+                         _MeasuredPoolMixin, _engine_options, _listen_worker,
+                         _prepare_schema, _renesting, _track_written_tables,
+                         _truncate_tables, _warm_statement_cache,
+                         load_fixtures)
+
 
 if sys.version_info < (3, 7):
     raise RuntimeError('Python >= 3.7 required.')
 
 
-__all__ = 'test_connection',
+__all__ = (
+    'build_async_engine', 'check_replicas', 'check_schema',
+    'nested_test_connection', 'routing_session', 'session_test_schema',
+    'test_connection', 'upgrade_database', 'upgrade_databases',
+    'warm_statement_cache',
+)
+
+
+def build_async_engine(
+    config: typing.Union[str, URL, typing.Mapping[str, typing.Any]],
+    *,
+    concurrency: typing.Optional[int] = None,
+    prefix: str = 'sqlalchemy.',
+    **kwargs
+) -> 'AsyncEngine':
+    """Create an async engine with a connection pool tuned for services.
+    It works like :func:`.sqlalchemy.build_engine`, and
+    :func:`.sqlalchemy.pool_statistics` also accepts the engine.
+
+    :param config: a database URL, or a configuration mapping of which keys
+                   start with ``prefix``
+    :param int concurrency: (Optional) The expected number of concurrent
+                            database users e.g. tasks.  Default: 5
+    :param str prefix: (Optional) The prefix of the configuration keys.
+                       Default: `'sqlalchemy.'`
+    :param kwargs: Extra options to
+                   :func:`~sqlalchemy.ext.asyncio.create_async_engine`
+    :return: SQLAlchemy async engine
+
+    """
+    if create_async_engine is None:
+        raise RuntimeError('SQLAlchemy >= 1.4 required.')
+    url, options = _engine_options(config, prefix, concurrency,
+                                   _MeasuredAsyncPool)
+    options.update(kwargs)
+    if isinstance(config, collections.abc.Mapping):
+        return async_engine_from_config(config, prefix, **options)
+    return create_async_engine(url, **options)
+
+
+if create_async_engine is not None:
+    class _MeasuredAsyncPool(_MeasuredPoolMixin, AsyncAdaptedQueuePool):
+        pass
+
+
+async def warm_statement_cache(
+    engine: 'AsyncEngine',
+    metadata: typing.Optional[MetaData] = None,
+    *,
+    statements: typing.Iterable[HotStatement] = (),
+    module_name: typing.Optional[str] = None,
+    crud: bool = True,
+) -> int:
+    """Compile statements into the compiled cache of ``engine``.
+    It works like :func:`.sqlalchemy.warm_statement_cache`.
+
+    :param engine: the async engine to warm up
+    :param MetaData metadata: (Optional) SQLAlchemy schema metadata
+    :param statements: (Optional) Hot statements in addition to the registered
+                       ones
+    :param str module_name: (Optional) The package to import all modules of
+                            first
+    :param bool crud: (Optional) Whether to compile common statements of
+                      every table in ``metadata``.  Default: `True`
+    :return: the number of statements newly compiled into the cache
+    :rtype: int
+
+    """
+    if create_async_engine is None:
+        raise RuntimeError('SQLAlchemy >= 1.4 required.')
+    if module_name:
+        import_all_modules(module_name)
+    async with engine.connect():
+        pass
+    return _warm_statement_cache(engine.sync_engine, metadata, statements,
+                                 crud)
+
+
+def routing_session(
+    router: Router,
+    **kwargs
+) -> 'AsyncSession':
+    """Create an async session which reads from replicas, and writes to
+    the primary, like :class:`.sqlalchemy.RoutingSession`.
+
+    :param router: the router of async engines
+    :type router: :class:`.sqlalchemy.Router`
+    :param kwargs: Extra options to
+                   :class:`~sqlalchemy.ext.asyncio.AsyncSession`
+    :return: SQLAlchemy async session
+
+    """
+    if create_async_engine is None:
+        raise RuntimeError('SQLAlchemy >= 1.4 required.')
+    return AsyncSession(sync_session_class=RoutingSession, router=router,
+                        **kwargs)
+
+
+async def check_replicas(router: Router) -> None:
+    """Check the health of the async replicas of ``router``.  Since
+    the router cannot check async engines by itself, run it periodically
+    e.g. in a background task.
+
+    :param router: the router of async engines
+    :type router: :class:`.sqlalchemy.Router`
+
+    """
+    router._checked_at = time.monotonic()
+    unhealthy = set()
+    for replica in router.replicas:
+        try:
+            async with replica.connect() as connection:
+                healthy = await connection.run_sync(router.is_healthy)
+        except Exception:
+            # not only DBAPIError, but also e.g. OSError from asyncpg
+            healthy = False
+        if not healthy:
+            unhealthy.add(replica)
+    router.unhealthy = unhealthy
 
 
 @contextlib.asynccontextmanager
 async def test_connection(
     ctx: object,
     metadata: MetaData,
-    engine: 'sqlalchemy.ext.asyncio.AsyncEngine',
+    engine: 'AsyncEngine',
     real_transaction: bool = False,
     ctx_connection_attribute_name: str = '_test_fx_connection',
+    dispose_engine: bool = True,
+    reset_connection: typing.Optional[
+        typing.Callable[[object], typing.Awaitable[None]]
+    ] = None,
+    truncate: bool = False,
+    fixtures: typing.Optional[Fixtures] = None,
 ):
     """asyncio version of :func:`.sqlalchemy.test_connection`.
     Since SQLAlchemy 1.4 supports asyncio, it needs to handle async engine
@@ -34,6 +178,20 @@ async def test_connection(
     :param str ctx_connection_attribute_name: (Optional) Attribute name for injecting
                                               test connection to the context object
                                               Default: `'_test_fx_connection'`
+    :param bool dispose_engine: (Optional) Whether to dispose the connection pool of
+                                ``engine`` at the end.  Default: `True`
+    :param reset_connection: (Optional) A coroutine function called with the connection
+                             after its transaction is rolled back, to reset its state
+                             before it goes back to the pool.
+    :param bool truncate: (Optional) With ``real_transaction``, keep the schema across
+                          tests and empty only the tables written during the test.
+                          It raises :exc:`ValueError` without ``real_transaction``.
+                          See also :func:`.sqlalchemy.test_connection`.  Default: `False`
+    :param fixtures: (Optional) Seed data to insert into the fresh schema before the test.
+                     See also :func:`.sqlalchemy.load_fixtures`.
+
+    Like the synchronous version, pytest-xdist workers are isolated from each
+    other automatically.
 
     .. code-block::
 
@@ -48,19 +206,288 @@ async def test_connection(
     """  # noqa
     if create_async_engine is None:
         raise RuntimeError('SQLAlchemy >= 1.4 required.')
+    if truncate and not real_transaction:
+        raise ValueError('truncate requires real_transaction')
+    engine = await _isolate_worker(engine)
+    if real_transaction and truncate:
+        if _prepare_schema(metadata, engine.sync_engine):
+            async with engine.begin() as connection:
+                await connection.run_sync(metadata.drop_all)
+                await connection.run_sync(metadata.create_all)
+        with _track_written_tables(metadata, engine.sync_engine) as written:
+            try:
+                async with engine.connect() as connection:
+                    setattr(ctx, ctx_connection_attribute_name, connection)
+                    try:
+                        if fixtures is not None:
+                            await connection.run_sync(load_fixtures, metadata,
+                                                      fixtures)
+                            await connection.commit()
+                        yield connection
+                    finally:
+                        delattr(ctx, ctx_connection_attribute_name)
+            finally:
+                async with engine.begin() as connection:
+                    await connection.run_sync(_truncate_tables, metadata,
+                                              written)
+        if dispose_engine:
+            await engine.dispose()
+        return
     if real_transaction:
         async with engine.begin() as connection:
             await connection.run_sync(metadata.create_all)
-    async with engine.connect() as connection:
-        setattr(ctx, ctx_connection_attribute_name, connection)
+            if fixtures is not None:
+                await connection.run_sync(load_fixtures, metadata, fixtures)
+    try:
+        async with engine.connect() as connection:
+            setattr(ctx, ctx_connection_attribute_name, connection)
+            try:
+                if real_transaction:
+                    yield connection
+                else:
+                    transaction = await connection.begin()
+                    try:
+                        await connection.run_sync(metadata.create_all)
+                        if fixtures is not None:
+                            await connection.run_sync(load_fixtures, metadata,
+                                                      fixtures)
+                        yield connection
+                    finally:
+                        await transaction.rollback()
+                        if reset_connection is not None:
+                            await reset_connection(connection)
+            finally:
+                delattr(ctx, ctx_connection_attribute_name)
+    finally:
         if real_transaction:
-            yield connection
-        else:
-            transaction = await connection.begin()
-            await connection.run_sync(metadata.create_all)
-            yield connection
-            await transaction.rollback()
-    if real_transaction:
+            async with engine.begin() as connection:
+                await connection.run_sync(metadata.drop_all)
+    if dispose_engine:
+        await engine.dispose()
+
+
+@contextlib.asynccontextmanager
+async def session_test_schema(
+    metadata: MetaData,
+    engine: 'AsyncEngine',
+    fixtures: typing.Optional[Fixtures] = None,
+):
+    """Session-scoped companion of :func:`nested_test_connection`.  It creates
+    the schema (and inserts ``fixtures``) only once, and drops it at the end.
+    It yields the engine to pass to :func:`nested_test_connection`, which
+    is isolated for a pytest-xdist worker like :func:`test_connection`.
+
+    :param MetaData metadata: SQLAlchemy schema metadata
+    :param engine: SQLAlchemy async engine
+    :param fixtures: (Optional) Seed data to insert once.
+                     See also :func:`.sqlalchemy.load_fixtures`.
+
+    .. code-block::
+
+       from pytest import fixture
+
+       @fixture(scope='session')
+       async def fx_test_engine(fx_engine: AsyncEngine):
+           async with session_test_schema(Base.metadata, fx_engine) as engine:
+               yield engine
+
+       @fixture
+       async def fx_connection(request, fx_test_engine: AsyncEngine):
+           async with nested_test_connection(request, fx_test_engine) as connection:
+               yield connection
+
+    """  # noqa
+    if create_async_engine is None:
+        raise RuntimeError('SQLAlchemy >= 1.4 required.')
+    engine = await _isolate_worker(engine)
+    async with engine.begin() as connection:
+        await connection.run_sync(metadata.drop_all)
+        await connection.run_sync(metadata.create_all)
+        if fixtures is not None:
+            await connection.run_sync(load_fixtures, metadata, fixtures)
+    try:
+        yield engine
+    finally:
         async with engine.begin() as connection:
             await connection.run_sync(metadata.drop_all)
-    await engine.dispose()
+        await engine.dispose()
+
+
+@contextlib.asynccontextmanager
+async def nested_test_connection(
+    ctx: object,
+    engine: 'AsyncEngine',
+    ctx_connection_attribute_name: str = '_test_fx_connection',
+):
+    """Run a test on its own connection inside a transaction and
+    a SAVEPOINT which are rolled back afterwards, even if the test fails.
+    If an :class:`~sqlalchemy.ext.asyncio.AsyncSession` bound to
+    the connection ends the SAVEPOINT (e.g. by committing), a new one is begun
+    automatically.  Since every test has its own connection, tests can
+    share the engine concurrently.
+
+    Unlike the synchronous :func:`.sqlalchemy.nested_test_connection` it takes
+    the engine yielded by :func:`session_test_schema`.
+
+    :param object ctx: Context object to inject test connection into attribute
+    :param engine: The engine yielded by :func:`session_test_schema`
+    :param str ctx_connection_attribute_name: (Optional) Attribute name for injecting
+                                              test connection to the context object
+                                              Default: `'_test_fx_connection'`
+
+    """  # noqa
+    if create_async_engine is None:
+        raise RuntimeError('SQLAlchemy >= 1.4 required.')
+    async with engine.connect() as connection:
+        sync_connection = connection.sync_connection
+
+        def renest():
+            if sync_connection.in_transaction() and \
+               not sync_connection.in_nested_transaction():
+                sync_connection.begin_nested()
+
+        transaction = await connection.begin()
+        try:
+            await connection.begin_nested()
+            setattr(ctx, ctx_connection_attribute_name, connection)
+            try:
+                with _renesting(sync_connection, renest):
+                    yield connection
+            finally:
+                delattr(ctx, ctx_connection_attribute_name)
+        finally:
+            await transaction.rollback()
+
+
+async def _isolate_worker(
+    engine: 'AsyncEngine',
+) -> 'AsyncEngine':
+    if not os.environ.get('PYTEST_XDIST_WORKER'):
+        return engine
+    if _listen_worker(engine.sync_engine):
+        await engine.dispose()
+    return engine
+
+
+async def upgrade_database(
+    config: Config,
+    engine: 'AsyncEngine',
+    metadata: MetaData,
+    *,
+    revision: str = 'head',
+    module_name: typing.Optional[str] = None,
+    **options
+) -> None:
+    """asyncio version of :func:`.alembic.upgrade_database`.  The migration
+    environment runs through :meth:`AsyncConnection.run_sync()
+    <sqlalchemy.ext.asyncio.AsyncConnection.run_sync>`, and the connection
+    is passed to ``env.py`` through ``config.attributes['connection']``
+    (see :func:`.alembic.upgrade_databases`).
+
+    Use :func:`upgrade_databases` to upgrade many databases concurrently.
+
+    """
+    if create_async_engine is None:
+        raise RuntimeError('SQLAlchemy >= 1.4 required.')
+    await upgrade_databases(
+        config, [engine], metadata,
+        revision=revision, module_name=module_name, stop_on_error=True,
+        **options
+    )
+
+
+async def upgrade_databases(
+    config: Config,
+    engines: typing.Iterable['AsyncEngine'],
+    metadata: MetaData,
+    *,
+    revision: str = 'head',
+    module_name: typing.Optional[str] = None,
+    stop_on_error: bool = False,
+    progress: typing.Optional[typing.Callable[[UpgradeResult], None]] = None,
+    **options
+) -> typing.Sequence[UpgradeResult]:
+    """asyncio version of :func:`.alembic.upgrade_databases`, which upgrades
+    the databases concurrently on the running event loop.  Like the threaded
+    version, the migration scripts themselves run one database at a time.
+
+    """
+    if create_async_engine is None:
+        raise RuntimeError('SQLAlchemy >= 1.4 required.')
+    # Parsing the script directory reads files, so it shouldn't block
+    # the event loop.
+    script = await asyncio.get_running_loop().run_in_executor(
+        None, _script_directory, config
+    )
+    dest = script.get_revision(revision)
+    dest = dest and dest.revision
+    lock = asyncio.Lock()
+
+    def get_current_revision(connection):
+        return MigrationContext.configure(connection).get_current_revision()
+
+    def upgrade(connection, engine):
+        _upgrade(_connection_config(config, connection), script,
+                 engine.sync_engine, metadata,
+                 revision=revision, module_name=module_name, **options)
+
+    async def run(engine):
+        start = time.perf_counter()
+        waited = 0.0
+        before = after = None
+        try:
+            async with engine.connect() as connection:
+                before = after = await connection.run_sync(
+                    get_current_revision
+                )
+                if before != dest:
+                    # Let env.py manage its own transactions.
+                    await connection.rollback()
+                    wait_start = time.perf_counter()
+                    async with lock:
+                        waited = time.perf_counter() - wait_start
+                        await connection.run_sync(upgrade, engine)
+                    await connection.commit()
+                    after = await connection.run_sync(get_current_revision)
+        except Exception as e:
+            result = UpgradeResult(engine, before, after,
+                                   time.perf_counter() - start - waited, e)
+        else:
+            result = UpgradeResult(engine, before, after,
+                                   time.perf_counter() - start - waited, None)
+        if progress is not None:
+            progress(result)
+        if result.error is not None and stop_on_error:
+            raise result.error
+        return result
+    tasks = [asyncio.ensure_future(run(engine)) for engine in engines]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        # gather() doesn't cancel the others, which would go on upgrading
+        # after the error has been raised to the caller.
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def check_schema(
+    config: Config,
+    engine: 'AsyncEngine',
+    metadata: MetaData,
+    *,
+    module_name: typing.Optional[str] = None,
+    version_table: str = 'alembic_version',
+) -> SchemaDrift:
+    """asyncio version of :func:`.alembic.check_schema`."""
+    if create_async_engine is None:
+        raise RuntimeError('SQLAlchemy >= 1.4 required.')
+    if module_name:
+        import_all_modules(module_name)
+    script = await asyncio.get_running_loop().run_in_executor(
+        None, _script_directory, config
+    )
+    async with engine.connect() as connection:
+        return await connection.run_sync(_check_schema, script, metadata,
+                                         version_table)
@@ -2,19 +2,78 @@
 ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 """
+import collections
+import collections.abc
 import contextlib
+import copy
+import hashlib
+import itertools
+import json
+import os
+import re
+import shutil
+import threading
+import time
 import typing
+import uuid
+import warnings
+import weakref
 
-from sqlalchemy.engine import Engine
+from sqlalchemy import create_engine, engine_from_config, inspect
+from sqlalchemy.engine import Connection, Engine
+try:
+    from sqlalchemy.engine import Row
+except ImportError:
+    # SQLAlchemy < 1.4
+    from sqlalchemy.engine import RowProxy as Row
+from sqlalchemy.engine.url import URL, make_url
+from sqlalchemy.event import contains, listen, remove
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.schema import MetaData
+from sqlalchemy.sql import compiler
+from sqlalchemy.sql.base import Executable
+from sqlalchemy.sql.expression import (ClauseElement, and_, bindparam,
+                                       text)
+try:
+    import yaml
+except ImportError:
+    yaml = None
 
-__all__ = 'repr_entity', 'test_connection'
+from .common import import_all_modules
 
+__all__ = (
+    'Fixtures', 'HotStatement', 'PoolStatistics', 'QueryProfile',
+    'QueryRecord', 'Router', 'RoutingSession', 'build_engine',
+    'drop_templates', 'load_fixtures', 'nested_test_connection',
+    'pool_statistics', 'profile_queries', 'query_budget',
+    'register_statement', 'repr_entity', 'serialize_entities',
+    'session_test_connection', 'test_connection', 'warm_statement_cache',
+)
 
-def repr_entity(entity: object) -> str:
+#: The default number of concurrent database users of :func:`build_engine`,
+#: which is the size of its connection pool.
+DEFAULT_CONCURRENCY = 5
+
+#: Seconds after which :func:`build_engine` recycles a pooled connection.
+POOL_RECYCLE = 3600
+
+#: Seconds :func:`build_engine` waits for a pooled connection before giving
+#: up.
+POOL_TIMEOUT = 30
+
+
+def repr_entity(
+    entity: object,
+    *,
+    loaded_only: bool = False,
+    max_length: typing.Optional[int] = None,
+) -> str:
     """Make a representation string for the given ``entity`` object.
     If the class specified ``__repr_columns__`` it prints
     these attributes instead of its primary keys.
+    Which attributes to print is looked up only once per class.
 
 
     .. code-block::
@@ -50,24 +109,717 @@ def repr_entity(entity: object) -> str:
           http://docs.sqlalchemy.org/en/latest/orm/extensions/declarative/api.html#sqlalchemy.ext.declarative.as_declarative
 
     :param entity: an object to make a representation string
+    :param bool loaded_only: (Optional) Read mapped attributes only from
+                             the already loaded state of the ``entity``,
+                             so that it never emits SQL (e.g. lazy loading
+                             of relationships or deferred columns).
+                             Attributes not loaded are printed as
+                             ``<unloaded>``.  Default: `False`
+    :param int or None max_length: (Optional) Truncate the representation of
+                                   each attribute value to this length,
+                                   followed by ``...``.  Strings and bytes
+                                   are truncated only if they are longer
+                                   than this.
     :return: a representation string
     :rtype: :class:`str`
 
     """  # noqa
     cls = type(entity)
+    if '__repr_columns__' in getattr(entity, '__dict__', ()):
+        # set on the instance, so it can't be cached per class
+        prefix, names = _compile_repr_plan(cls, entity.__repr_columns__)
+    else:
+        try:
+            prefix, names = _repr_plans[cls]
+        except KeyError:
+            prefix, names = _repr_plans[cls] = _compile_repr_plan(cls)
+    return _format_repr(prefix, _entity_pairs(entity, names, loaded_only),
+                        max_length)
+
+
+def serialize_entities(
+    entities: typing.Iterable[object],
+    format: str = 'repr',
+    *,
+    loaded_only: bool = False,
+    max_length: typing.Optional[int] = None,
+) -> typing.Iterator[str]:
+    """Serialize many entities, or rows of Core queries, one by one for
+    dumping large results.  It's a generator, so pass a streamed result
+    (e.g. :meth:`Query.yield_per() <sqlalchemy.orm.Query.yield_per>`)
+    to keep memory usage flat.
+
+    .. code-block::
+
+       with open('songs.jsonl', 'w') as f:
+           for line in serialize_entities(session.query(Song).yield_per(1000),
+                                          'json', loaded_only=True):
+               print(line, file=f)
+
+    :param entities: entities or rows to serialize
+    :param str format: (Optional) ``'repr'`` for the same strings as
+                       :func:`repr_entity`, or ``'json'`` for JSON objects.
+                       Default: `'repr'`
+    :param bool loaded_only: (Optional) See :func:`repr_entity`.
+    :param int or None max_length: (Optional) See :func:`repr_entity`.
+                                   Only for ``'repr'``.
+    :return: an iterator of serialized strings
+
+    """  # noqa
+    if format not in ('repr', 'json'):
+        raise ValueError('format must be repr or json, not ' + repr(format))
+    plans = {}
+    for entity in entities:
+        cls = type(entity)
+        try:
+            prefix, names = plans[cls]
+        except KeyError:
+            if isinstance(entity, Row):
+                prefix, names = '<' + cls.__name__ + ' ', None
+            else:
+                try:
+                    prefix, names = _repr_plans[cls]
+                except KeyError:
+                    prefix, names = _repr_plans[cls] = \
+                        _compile_repr_plan(cls)
+            plans[cls] = prefix, names
+        if '__repr_columns__' in getattr(entity, '__dict__', ()):
+            prefix, names = _compile_repr_plan(cls, entity.__repr_columns__)
+        if names is None:
+            # Row.keys() is deprecated since SQLAlchemy 1.4
+            keys = entity._fields if hasattr(entity, '_fields') \
+                else entity.keys()
+            pairs = zip(keys, entity)
+        else:
+            pairs = _entity_pairs(entity, names, loaded_only)
+        if format == 'repr':
+            yield _format_repr(prefix, pairs, max_length)
+        else:
+            data = {k: v for k, v in pairs if v is not _missing}
+            if names is not None:
+                data['__type__'] = prefix[1:-1]
+            yield json.dumps(data, default=str)
+
+
+def _entity_pairs(
+    entity: object,
+    names: typing.Sequence[str],
+    loaded_only: bool,
+) -> typing.Iterator[typing.Tuple[str, object]]:
+    if loaded_only:
+        state = inspect(entity, raiseerr=False)
+        return ((name, _get_loaded(entity, state, name)) for name in names)
+    return ((name, getattr(entity, name, _missing)) for name in names)
+
+
+def _format_repr(
+    prefix: str,
+    pairs: typing.Iterable[typing.Tuple[str, object]],
+    max_length: typing.Optional[int],
+) -> str:
+    if max_length is None:
+        return prefix + ' '.join(k + '=' + repr(v)
+                                 for k, v in pairs if v is not _missing) + '>'
+    return prefix + ' '.join(k + '=' + _truncated_repr(v, max_length)
+                             for k, v in pairs if v is not _missing) + '>'
+
+
+#: The prefix and attribute names :func:`repr_entity` prints for each class,
+#: made by :func:`_compile_repr_plan`.
+_repr_plans = weakref.WeakKeyDictionary()
+
+_missing = object()
+
+
+class _Unloaded:
+
+    def __repr__(self):
+        return '<unloaded>'
+
+
+_unloaded = _Unloaded()
+
+
+def _get_loaded(entity: object, state, name: str) -> object:
+    if state is None or name not in state.manager:
+        # not a mapped attribute
+        return getattr(entity, name, _missing)
+    return state.dict.get(name, _unloaded)
+
+
+def _truncated_repr(value: object, max_length: int) -> str:
+    if value is _unloaded:
+        return repr(value)
+    if isinstance(value, (str, bytes)):
+        # Strings are measured without quotes, and sliced before repr() to
+        # avoid making a huge string only to truncate it.
+        if len(value) <= max_length:
+            return repr(value)
+        return repr(value[:max_length]) + '...'
+    result = repr(value)
+    if len(result) > max_length:
+        return result[:max_length] + '...'
+    return result
+
+
+def _compile_repr_plan(
+    cls: type,
+    columns: typing.Optional[typing.Sequence] = None,
+) -> typing.Tuple[str, typing.Tuple[str, ...]]:
     mod = cls.__module__
     name = ('' if mod == '__main__ ' else mod + '.') + cls.__qualname__
+    if columns is None:
+        try:
+            columns = cls.__repr_columns__
+        except AttributeError:
+            columns = cls.__mapper__.primary_key
+    names = tuple(column if isinstance(column, str) else column.name
+                  for column in columns)
+    return '<' + name + ' ', names
+
+
+#: Seed data for :func:`load_fixtures`: rows (mappings of column names to
+#: values) by table name, or the path of a YAML file of the same structure.
+Fixtures = typing.Union[
+    typing.Mapping[str, typing.Sequence[typing.Mapping[str, object]]],
+    str,
+]
+
+
+def load_fixtures(
+    bind: typing.Union[Engine, Connection],
+    metadata: MetaData,
+    fixtures: Fixtures,
+) -> None:
+    """Insert seed data into the tables of ``metadata`` in dependency order.
+    Rows of a table are inserted with a single ``executemany()`` as long as
+    consecutive rows have the same columns.
+
+    .. code-block:: yaml
+
+       artist:
+       - {id: 1, name: Oasis}
+       song:
+       - {id: 1, artist_id: 1, name: Wonderwall}
+
+    :param bind: an engine or a connection to insert the data
+    :param MetaData metadata: SQLAlchemy schema metadata
+    :param fixtures: rows (mappings of column names to values) by table name,
+                     or the path of a YAML file (requires PyYAML_)
+
+    .. _PyYAML: https://pyyaml.org/
+
+    """
+    if isinstance(fixtures, str):
+        if yaml is None:
+            raise RuntimeError('PyYAML required.')
+        with open(fixtures) as f:
+            fixtures = yaml.safe_load(f) or {}
+    unknown = set(fixtures) - set(metadata.tables)
+    if unknown:
+        raise ValueError('unknown tables: ' + ', '.join(sorted(unknown)))
+    if isinstance(bind, Engine):
+        with bind.begin() as connection:
+            load_fixtures(connection, metadata, fixtures)
+        return
+    for table in metadata.sorted_tables:
+        for _, rows in itertools.groupby(fixtures.get(table.key) or (),
+                                         key=lambda row: sorted(row)):
+            bind.execute(table.insert(), list(rows))
+
+
+#: Snapshot of the connection pool of an engine built by :func:`build_engine`.
+#: ``checked_out`` and ``overflow`` are the current state, and the others
+#: are accumulated since the engine was built, e.g. ``peak_overflow`` is
+#: the largest overflow observed.  ``wait_time`` and
+#: ``max_wait_time`` are the time spent on checking out connections
+#: (including pre-ping), in seconds.
+PoolStatistics = typing.NamedTuple('PoolStatistics', [
+    ('size', int),
+    ('checked_out', int),
+    ('overflow', int),
+    ('peak_overflow', int),
+    ('checkouts', int),
+    ('connects', int),
+    ('timeouts', int),
+    ('wait_time', float),
+    ('max_wait_time', float),
+])
+
+
+def build_engine(
+    config: typing.Union[str, URL, typing.Mapping[str, typing.Any]],
+    *,
+    concurrency: typing.Optional[int] = None,
+    prefix: str = 'sqlalchemy.',
+    **kwargs
+) -> Engine:
+    """Create an engine with a connection pool tuned for services.
+
+    - The pool keeps ``concurrency`` connections and allows half as many
+      overflow connections for bursts.
+    - Connections are checked with pre-ping, recycled after an hour, and
+      reused in LIFO order so that idle connections beyond the demand can
+      time out on the server side.
+    - :func:`pool_statistics` reports checkouts, wait time and overflow.
+
+    Pool options are not applied to in-memory SQLite databases, which
+    cannot be shared by pooled connections.
+
+    :param config: a database URL, or a configuration mapping of which keys
+                   start with ``prefix`` like
+                   :func:`~sqlalchemy.engine_from_config`.  Options given
+                   in the mapping take precedence over the defaults
+    :param int concurrency: (Optional) The expected number of concurrent
+                            database users e.g. threads.  Default: 5
+    :param str prefix: (Optional) The prefix of the configuration keys.
+                       Default: `'sqlalchemy.'`
+    :param kwargs: Extra options to :func:`~sqlalchemy.create_engine`,
+                   which take precedence over all
+    :return: SQLAlchemy engine
+
+    .. code-block::
+
+       engine = build_engine(app.config, concurrency=16)
+
+    """
+    url, options = _engine_options(config, prefix, concurrency,
+                                   _MeasuredQueuePool)
+    options.update(kwargs)
+    if isinstance(config, collections.abc.Mapping):
+        return engine_from_config(config, prefix, **options)
+    return create_engine(url, **options)
+
+
+def pool_statistics(engine) -> PoolStatistics:
+    """Get the statistics of the connection pool of ``engine``.
+
+    :param engine: an engine built by :func:`build_engine` or
+                   :func:`.asyncsqlalchemy.build_async_engine`
+    :return: the statistics of the pool
+    :rtype: :class:`PoolStatistics`
+
+    """
+    pool = getattr(engine, 'sync_engine', engine).pool
+    counters = getattr(pool, 'counters', None)
+    if counters is None:
+        raise ValueError('the engine has no pool statistics; '
+                         'it has to be built by build_engine()')
+    return PoolStatistics(
+        size=pool.size(),
+        checked_out=pool.checkedout(),
+        overflow=max(pool.overflow(), 0),
+        peak_overflow=counters.peak_overflow,
+        checkouts=counters.checkouts,
+        connects=counters.connects,
+        timeouts=counters.timeouts,
+        wait_time=counters.wait_time,
+        max_wait_time=counters.max_wait_time,
+    )
+
+
+#: A statement recorded by :func:`profile_queries`.  ``elapsed`` is in
+#: seconds, and ``rowcount`` is :const:`None` if the driver does not know it
+#: (e.g. ``SELECT`` on SQLite).  Statements which differ only in literals
+#: and parameters have the same ``fingerprint``.
+QueryRecord = typing.NamedTuple('QueryRecord', [
+    ('statement', str),
+    ('fingerprint', str),
+    ('elapsed', float),
+    ('rowcount', typing.Optional[int]),
+])
+
+
+class QueryProfile:
+    """Statements recorded by :func:`profile_queries`."""
+
+    def __init__(self) -> None:
+        #: (:class:`typing.List`\ [:class:`QueryRecord`]) In execution order.
+        self.records = []
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    @property
+    def total_time(self) -> float:
+        """The total time spent on executing statements, in seconds."""
+        return sum(record.elapsed for record in self.records)
+
+    def slow_queries(self, threshold: float) -> typing.List[QueryRecord]:
+        """Get statements which took longer than ``threshold`` seconds."""
+        return [r for r in self.records if r.elapsed > threshold]
+
+    def n_plus_one(
+        self,
+        threshold: int = 5,
+    ) -> typing.List[typing.Tuple[str, int]]:
+        """Find N+1 patterns, i.e. fingerprints executed ``threshold`` or
+        more times, typically by lazy loading in a loop.
+
+        :param int threshold: (Optional) The minimum number of executions.
+                              Default: 5
+        :return: pairs of a fingerprint and its number of executions,
+                 the most frequent first
+
+        """
+        counts = collections.Counter(r.fingerprint for r in self.records)
+        return [(fingerprint, count)
+                for fingerprint, count in counts.most_common()
+                if count >= threshold]
+
+    def summary(self, limit: int = 10) -> str:
+        """Format the most frequent fingerprints with their total time."""
+        times = collections.defaultdict(float)
+        counts = collections.Counter()
+        for record in self.records:
+            times[record.fingerprint] += record.elapsed
+            counts[record.fingerprint] += 1
+        lines = ['{} statements in {:.6f}s'.format(len(self), self.total_time)]
+        lines.extend(
+            '{:5d} {:10.6f}s  {}'.format(count, times[fingerprint],
+                                         fingerprint)
+            for fingerprint, count in counts.most_common(limit)
+        )
+        return '\n'.join(lines)
+
+
+@contextlib.contextmanager
+def profile_queries(bind) -> typing.Generator:
+    """Record the statements executed through ``bind`` in the block.
+
+    .. code-block::
+
+       with profile_queries(engine) as profile:
+           for artist in session.query(Artist):
+               artist.songs
+       assert not profile.n_plus_one()
+
+    :param bind: an :class:`~sqlalchemy.engine.Engine`,
+                 :class:`~sqlalchemy.engine.Connection` (e.g. the one
+                 yielded by :func:`test_connection`), or their asyncio
+                 counterparts
+    :return: the profile to be filled
+    :rtype: :class:`QueryProfile`
+
+    """
+    # AsyncConnection has sync_engine as well, which would widen the profile
+    # to every connection of the engine
+    target = getattr(bind, 'sync_connection', None) or \
+        getattr(bind, 'sync_engine', None) or bind
+    profile = QueryProfile()
+    starts = {}
+
+    def before(conn, cursor, statement, parameters, context, executemany):
+        starts[id(context)] = time.perf_counter()
+
+    def after(conn, cursor, statement, parameters, context, executemany):
+        start = starts.pop(id(context), None)
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        rowcount = getattr(cursor, 'rowcount', -1)
+        profile.records.append(QueryRecord(
+            statement=statement,
+            fingerprint=_fingerprint_statement(statement),
+            elapsed=elapsed,
+            rowcount=None if rowcount is None or rowcount < 0 else rowcount,
+        ))
+
+    listen(target, 'before_cursor_execute', before)
+    listen(target, 'after_cursor_execute', after)
     try:
-        columns = entity.__repr_columns__
-    except AttributeError:
-        columns = cls.__mapper__.primary_key
-    names = (column if isinstance(column, str) else column.name
-             for column in columns)
-    pairs = ((name, getattr(entity, name))
-             for name in names
-             if hasattr(entity, name))
-    args = ' '.join(k + '=' + repr(v) for k, v in pairs)
-    return '<{0} {1}>'.format(name, args)
+        yield profile
+    finally:
+        remove(target, 'before_cursor_execute', before)
+        remove(target, 'after_cursor_execute', after)
+
+
+@contextlib.contextmanager
+def query_budget(
+    bind,
+    *,
+    max_queries: typing.Optional[int] = None,
+    max_time: typing.Optional[float] = None,
+    max_repeats: typing.Optional[int] = None,
+) -> typing.Generator:
+    """Assert the statements executed through ``bind`` in the block stay
+    within the budget.  It raises :exc:`AssertionError` with the summary
+    of the statements, so it fails a test.
+
+    .. code-block::
+
+       def test_list_artists(fx_connection):
+           with query_budget(fx_connection, max_queries=2, max_repeats=1):
+               list_artists(Session(bind=fx_connection))
+
+    :param bind: the same as :func:`profile_queries`
+    :param int max_queries: (Optional) The maximum number of statements
+    :param float max_time: (Optional) The maximum total time in seconds
+    :param int max_repeats: (Optional) The maximum number of executions
+                            of a fingerprint; exceeding it means N+1
+    :return: the profile to be filled
+    :rtype: :class:`QueryProfile`
+
+    """
+    with profile_queries(bind) as profile:
+        yield profile
+    errors = []
+    if max_queries is not None and len(profile) > max_queries:
+        errors.append('{} statements executed; budget is {}'.format(
+            len(profile), max_queries
+        ))
+    if max_time is not None and profile.total_time > max_time:
+        errors.append('statements took {:.6f}s; budget is {}s'.format(
+            profile.total_time, max_time
+        ))
+    if max_repeats is not None:
+        for fingerprint, count in profile.n_plus_one(max_repeats + 1):
+            errors.append('executed {} times; budget is {}: {}'.format(
+                count, max_repeats, fingerprint
+            ))
+    if errors:
+        raise AssertionError('\n'.join(errors + [profile.summary()]))
+
+
+#: A statement to compile in advance, optionally with the parameters it is
+#: executed with.  Only the keys of the parameters matter, and a list of
+#: parameters means ``executemany()``.
+HotStatement = typing.Union[
+    Executable,
+    typing.Tuple[Executable, typing.Union[typing.Mapping[str, object],
+                                          typing.Sequence[typing.Mapping[
+                                              str, object]]]],
+]
+
+#: Statements registered by :func:`register_statement`.
+_hot_statements = []
+
+
+def register_statement(
+    statement: Executable,
+    parameters: typing.Union[
+        None,
+        typing.Mapping[str, object],
+        typing.Sequence[typing.Mapping[str, object]],
+    ] = None,
+) -> Executable:
+    """Register a hot statement to be compiled by
+    :func:`warm_statement_cache`.
+
+    .. code-block::
+
+       recent_songs = register_statement(
+           select(Song).order_by(Song.created_at.desc()).limit(10)
+       )
+
+    :param statement: the statement, which has to be executed as is
+                      (e.g. without additional ``where()``) to hit the cache
+    :param parameters: (Optional) The parameters it is executed with.
+                       Only the keys matter
+    :return: the ``statement`` as it is
+
+    """
+    if parameters is None:
+        _hot_statements.append(statement)
+    else:
+        _hot_statements.append((statement, parameters))
+    return statement
+
+
+def warm_statement_cache(
+    engine: Engine,
+    metadata: typing.Optional[MetaData] = None,
+    *,
+    statements: typing.Iterable[HotStatement] = (),
+    module_name: typing.Optional[str] = None,
+    crud: bool = True,
+) -> int:
+    """Compile statements into the compiled cache of ``engine``, so that
+    their first executions after the startup do not pay for compilation.
+
+    It compiles the statements registered by :func:`register_statement`,
+    ``statements``, and when ``crud`` is turned on, the following statements
+    for each table in ``metadata``:
+
+    - ``SELECT`` by the primary key
+    - ``INSERT`` of all columns, both a row and many rows
+    - ``UPDATE`` of all columns by the primary key
+    - ``DELETE`` by the primary key
+
+    :param engine: the engine to warm up
+    :param MetaData metadata: (Optional) SQLAlchemy schema metadata
+    :param statements: (Optional) Hot statements in addition to the registered
+                       ones.  See also :data:`HotStatement`
+    :param str module_name: (Optional) The package to import all modules of
+                            first, to define all tables and register all
+                            statements
+    :param bool crud: (Optional) Whether to compile common statements of
+                      every table in ``metadata``.  Default: `True`
+    :return: the number of statements newly compiled into the cache
+    :rtype: int
+
+    """
+    if not hasattr(ClauseElement, '_compile_w_cache'):
+        raise RuntimeError('SQLAlchemy >= 1.4 required.')
+    if module_name:
+        import_all_modules(module_name)
+    # Compiled SQL depends on the server version, which is detected on
+    # the first connection.
+    with engine.connect():
+        pass
+    return _warm_statement_cache(engine, metadata, statements, crud)
+
+
+class Router:
+    """Chooses an engine between the primary and read replicas for
+    :class:`RoutingSession`.
+
+    Replicas are checked every ``check_interval`` seconds in a background
+    thread, so that a dead replica doesn't stall reads: a replica which
+    cannot be connected to, or lags behind the primary more than ``max_lag``
+    seconds, is not chosen until a later check passes.  If no replica is
+    available, the primary is chosen instead.  Replicas are regarded as
+    available until the first check finishes, so call :meth:`check` at
+    startup to check them up front.
+
+    :param primary: the engine of the primary
+    :param replicas: the engines of the read replicas
+    :param str strategy: (Optional) ``'round_robin'``, or
+                         ``'least_connections'`` which chooses the replica
+                         whose pool has the fewest checked out connections.
+                         Default: `'round_robin'`
+    :param float max_lag: (Optional) The maximum replication lag in seconds
+    :param lag: (Optional) A function which takes a connection to a replica
+                and returns its replication lag in seconds, or
+                :const:`None` if unknown.  It is measured by default only on
+                PostgreSQL
+    :param float check_interval: (Optional) Seconds between health checks.
+                                 Default: 30
+
+    Engines may be :class:`~sqlalchemy.ext.asyncio.AsyncEngine` as well,
+    but then health checks have to be run by
+    :func:`.asyncsqlalchemy.check_replicas`.
+
+    """
+
+    def __init__(
+        self,
+        primary,
+        replicas: typing.Sequence,
+        *,
+        strategy: str = 'round_robin',
+        max_lag: typing.Optional[float] = None,
+        lag: typing.Optional[
+            typing.Callable[[Connection], typing.Optional[float]]
+        ] = None,
+        check_interval: float = 30.0,
+    ) -> None:
+        if strategy not in ('round_robin', 'least_connections'):
+            raise ValueError('unknown strategy: {!r}'.format(strategy))
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.strategy = strategy
+        self.max_lag = max_lag
+        self.lag = lag or _replication_lag
+        self.check_interval = check_interval
+        #: (:class:`typing.Set`) Replicas which failed the last check.
+        self.unhealthy = set()
+        self._checked_at = None
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def replica(self):
+        """Choose a replica, or the primary if none is available.
+
+        :return: an engine, which is synchronous even if the router has
+                 async engines
+
+        """
+        if not any(hasattr(e, 'sync_engine') for e in self.replicas) and \
+           self._check_due():
+            # Connecting to a dead replica can take as long as the connect
+            # timeout, which shouldn't be paid by a query.
+            threading.Thread(target=self.check, daemon=True).start()
+        candidates = [r for r in self.replicas if r not in self.unhealthy]
+        if not candidates:
+            return _sync_engine(self.primary)
+        if self.strategy == 'least_connections':
+            return min(
+                (_sync_engine(r) for r in candidates),
+                key=lambda engine: getattr(engine.pool, 'checkedout',
+                                           lambda: 0)()
+            )
+        return _sync_engine(candidates[next(self._counter) % len(candidates)])
+
+    def check(self) -> None:
+        """Check the health of all replicas now."""
+        self._checked_at = time.monotonic()
+        unhealthy = set()
+        for replica in self.replicas:
+            try:
+                with replica.connect() as connection:
+                    healthy = self.is_healthy(connection)
+            except Exception:
+                # not only DBAPIError, but also e.g. pool TimeoutError
+                healthy = False
+            if not healthy:
+                unhealthy.add(replica)
+        self.unhealthy = unhealthy
+
+    def _check_due(self) -> bool:
+        # Only one of concurrent callers runs the check.
+        now = time.monotonic()
+        with self._lock:
+            if self._checked_at is not None and \
+               now - self._checked_at < self.check_interval:
+                return False
+            self._checked_at = now
+            return True
+
+    def is_healthy(self, connection: Connection) -> bool:
+        """Whether the replica of ``connection`` is available."""
+        if self.max_lag is None:
+            connection.execute(text('SELECT 1'))
+            return True
+        lag = self.lag(connection)
+        return lag is None or lag <= self.max_lag
+
+
+class RoutingSession(Session):
+    """A session which reads from replicas, and writes to the primary.
+    Once it has flushed or executed a statement other than a plain
+    ``SELECT`` (including ``SELECT ... FOR UPDATE`` and :func:`text`),
+    it sticks to the primary until the transaction ends, so that it can
+    read its own writes.
+
+    .. code-block::
+
+       router = Router(primary_engine, [replica_engine1, replica_engine2])
+       Session = sessionmaker(class_=RoutingSession, router=router)
+
+    :param Router router: the router to choose engines
+
+    """
+
+    def __init__(self, router: Router, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.router = router
+        self.sticky = False
+        listen(self, 'after_transaction_end', self._unstick)
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.sticky or self._flushing or not _is_read(clause):
+            self.use_primary()
+            return _sync_engine(self.router.primary)
+        return self.router.replica()
+
+    def use_primary(self) -> None:
+        """Stick to the primary until the current transaction ends."""
+        self.sticky = True
+
+    def _unstick(self, session: Session, transaction) -> None:
+        if transaction.parent is None:
+            self.sticky = False
 
 
 @contextlib.contextmanager
@@ -77,6 +829,13 @@ def test_connection(
     engine: Engine,
     real_transaction: bool = False,
     ctx_connection_attribute_name: str = '_test_fx_connection',
+    use_template: bool = False,
+    dispose_engine: bool = True,
+    reset_connection: typing.Optional[
+        typing.Callable[[Connection], None]
+    ] = None,
+    truncate: bool = False,
+    fixtures: typing.Optional['Fixtures'] = None,
 ) -> typing.Generator:
     """Joining a SQLAlchemy session into an external transaction for test suit.
 
@@ -87,6 +846,45 @@ def test_connection(
     :param str ctx_connection_attribute_name: (Optional) Attribute name for injecting
                                               test connection to the context object
                                               Default: `'_test_fx_connection'`
+    :param bool use_template: (Optional) Build the schema only once into a template
+                              database and give every test a fresh clone of it,
+                              so that the setup cost doesn't grow with the number
+                              of tables.  Supported on PostgreSQL
+                              (``CREATE DATABASE ... TEMPLATE``) and on file-based
+                              SQLite (the template file is copied).  A template is
+                              built for each different schema, and they are kept
+                              until :func:`drop_templates` is called.  Default: `False`
+    :param bool dispose_engine: (Optional) Whether to dispose the connection pool of
+                                ``engine`` at the end.  Turn it off to reuse pooled
+                                connections across tests, and dispose the engine
+                                at the end of the test session instead.  Default: `True`
+    :param reset_connection: (Optional) A function called with the connection after
+                             its transaction is rolled back, to reset its state before
+                             it goes back to the pool, e.g.::
+
+                                 def discard_all(connection):
+                                     connection.execution_options(
+                                         isolation_level='AUTOCOMMIT'
+                                     ).exec_driver_sql('DISCARD ALL')
+
+    :param bool truncate: (Optional) With ``real_transaction``, keep the schema across
+                          tests instead of creating and dropping it every time,
+                          and empty only the tables written during the test
+                          afterwards, using a single ``TRUNCATE ... RESTART IDENTITY
+                          CASCADE`` on PostgreSQL or ``DELETE`` on other databases.
+                          Writes through textual SQL aren't tracked.  The tables are
+                          dropped and created again for the first test, since those
+                          left by a previous run can be stale.  It raises
+                          :exc:`ValueError` without ``real_transaction``, or with
+                          ``use_template``.  Default: `False`
+    :param fixtures: (Optional) Seed data to insert into the fresh schema before the test.
+                     See also :func:`load_fixtures`.
+
+    When it runs inside a pytest-xdist_ worker every worker gets its own
+    PostgreSQL schema (through ``search_path``) or its own SQLite database file,
+    so that parallel workers don't drop each other's tables.
+
+    .. _pytest-xdist: https://github.com/pytest-dev/pytest-xdist
 
     .. seealso::
 
@@ -94,9 +892,46 @@ def test_connection(
           <http://docs.sqlalchemy.org/en/latest/orm/session_transaction.html#joining-a-session-into-an-external-transaction-such-as-for-test-suites>
 
     """  # noqa
+    if truncate and not real_transaction:
+        raise ValueError('truncate requires real_transaction')
+    if truncate and use_template:
+        raise ValueError('truncate cannot be combined with use_template')
+    engine = _isolate_worker(engine)
+    if use_template:
+        with _clone_database(metadata, engine) as clone:
+            if fixtures is not None:
+                load_fixtures(clone, metadata, fixtures)
+            if real_transaction:
+                yield clone
+                return
+            connection = clone.connect()
+            try:
+                setattr(ctx, ctx_connection_attribute_name, connection)
+                try:
+                    yield connection
+                finally:
+                    delattr(ctx, ctx_connection_attribute_name)
+            finally:
+                connection.close()
+        return
+    if real_transaction and truncate:
+        if _prepare_schema(metadata, engine):
+            metadata.drop_all(engine, checkfirst=True)
+            metadata.create_all(engine)
+        with _track_written_tables(metadata, engine) as written:
+            try:
+                if fixtures is not None:
+                    load_fixtures(engine, metadata, fixtures)
+                yield engine
+            finally:
+                with engine.begin() as connection:
+                    _truncate_tables(connection, metadata, written)
+        return
     if real_transaction:
         metadata.create_all(engine)
         try:
+            if fixtures is not None:
+                load_fixtures(engine, metadata, fixtures)
             yield engine
         finally:
             metadata.drop_all(engine, checkfirst=True)
@@ -107,6 +942,8 @@ def test_connection(
         transaction = connection.begin()
         try:
             metadata.create_all(bind=connection)
+            if fixtures is not None:
+                load_fixtures(connection, metadata, fixtures)
             setattr(ctx, ctx_connection_attribute_name, connection)
             try:
                 yield connection
@@ -114,6 +951,662 @@ def test_connection(
                 delattr(ctx, ctx_connection_attribute_name)
         finally:
             transaction.rollback()
+            if reset_connection is not None:
+                reset_connection(connection)
+    finally:
+        connection.close()
+    if dispose_engine:
+        engine.dispose()
+
+
+@contextlib.contextmanager
+def session_test_connection(
+    metadata: MetaData,
+    engine: Engine,
+    fixtures: typing.Optional['Fixtures'] = None,
+) -> typing.Generator:
+    """Session-scoped companion of :func:`nested_test_connection`.  It creates
+    the schema only once on a long-lived connection inside a transaction
+    which is rolled back at the end, so that every test can share it.
+
+    :param MetaData metadata: SQLAlchemy schema metadata
+    :param Engine engine: SQLAlchemy engine
+    :param fixtures: (Optional) Seed data to insert once (see :func:`load_fixtures`).
+                     Since every test is rolled back to the seeded state, it's
+                     a cheap snapshot of seed data shared by all tests.
+
+    .. code-block::
+
+       from pytest import fixture
+
+       @fixture(scope='session')
+       def fx_session_connection(fx_engine):
+           with session_test_connection(Base.metadata, fx_engine) as connection:
+               yield connection
+
+       @fixture
+       def fx_connection(request, fx_session_connection):
+           with nested_test_connection(request, fx_session_connection) as connection:
+               yield connection
+
+    """  # noqa
+    engine = _isolate_worker(engine)
+    connection = engine.connect()
+    try:
+        metadata.drop_all(connection, checkfirst=True)
+        transaction = connection.begin()
+        try:
+            metadata.create_all(bind=connection)
+            if fixtures is not None:
+                load_fixtures(connection, metadata, fixtures)
+            yield connection
+        finally:
+            transaction.rollback()
     finally:
         connection.close()
     engine.dispose()
+
+
+@contextlib.contextmanager
+def nested_test_connection(
+    ctx: object,
+    connection: Connection,
+    ctx_connection_attribute_name: str = '_test_fx_connection',
+) -> typing.Generator:
+    """Run a test inside a SAVEPOINT of the ``connection`` made by
+    :func:`session_test_connection`, and roll it back afterwards.
+    If the code under test ends the SAVEPOINT (e.g. by calling
+    :meth:`Session.commit() <sqlalchemy.orm.session.Session.commit>`)
+    a new one is begun automatically, so nothing leaks into the next test.
+
+    :param object ctx: Context object to inject test connection into attribute
+    :param Connection connection: The connection yielded by
+                                  :func:`session_test_connection`
+    :param str ctx_connection_attribute_name: (Optional) Attribute name for injecting
+                                              test connection to the context object
+                                              Default: `'_test_fx_connection'`
+
+    """  # noqa
+    # The outer SAVEPOINT marks the state before the test and is never exposed
+    # to the code under test, which may only end the inner one.
+    test_savepoint = connection.begin_nested()
+    savepoint = connection.begin_nested()
+
+    def renest():
+        nonlocal savepoint
+        if not savepoint.is_active and test_savepoint.is_active:
+            savepoint = connection.begin_nested()
+
+    setattr(ctx, ctx_connection_attribute_name, connection)
+    try:
+        with _renesting(connection, renest):
+            yield connection
+    finally:
+        delattr(ctx, ctx_connection_attribute_name)
+        # Innermost first, so that the connection doesn't keep a stale
+        # nested transaction.
+        if savepoint.is_active:
+            savepoint.rollback()
+        if test_savepoint.is_active:
+            test_savepoint.rollback()
+
+
+def drop_templates() -> None:
+    """Drop the template databases built by :func:`test_connection` with
+    ``use_template`` in this process, e.g. at the end of the test session.
+
+    .. code-block::
+
+       @fixture(scope='session', autouse=True)
+       def fx_templates():
+           yield
+           drop_templates()
+
+    """
+    while _templates:
+        _, (engine, template) = _templates.popitem()
+        if engine.dialect.name == 'sqlite':
+            if os.path.exists(template):
+                os.remove(template)
+            continue
+        quoted = engine.dialect.identifier_preparer.quote(template)
+        admin = engine.execution_options(isolation_level='AUTOCOMMIT')
+        with admin.connect() as connection:
+            connection.execute(text('DROP DATABASE IF EXISTS ' + quoted))
+
+
+#: The functions which begin a new SAVEPOINT on the connections of
+#: :func:`nested_test_connection`, keyed by the connections.
+_renest_functions = {}
+_renest_lock = threading.Lock()
+
+
+def _renest(session: Session, transaction) -> None:
+    # The only listener for all sessions.  Adding and removing a listener of
+    # the Session class for every test races with sessions which end their
+    # transactions concurrently in other threads or tasks.
+    renest = _renest_functions.get(session.bind)
+    if renest is not None:
+        renest()
+
+
+@contextlib.contextmanager
+def _renesting(
+    connection: Connection,
+    renest: typing.Callable[[], None],
+) -> typing.Generator:
+    with _renest_lock:
+        if not contains(Session, 'after_transaction_end', _renest):
+            listen(Session, 'after_transaction_end', _renest)
+    _renest_functions[connection] = renest
+    try:
+        yield
+    finally:
+        del _renest_functions[connection]
+
+
+#: The template databases already built in this process and the engines of
+#: their original databases, keyed by the URL of the original database and
+#: the fingerprint of the schema.
+_templates = {}
+
+
+def _fingerprint_metadata(metadata: MetaData, dialect_name: str) -> str:
+    # Everything which can make a difference to the DDL has to be covered,
+    # since the DDL is reused as long as the fingerprint is the same.
+    hash_ = hashlib.sha256(dialect_name.encode())
+    for table in metadata.sorted_tables:
+        parts = [(table.schema, table.name, table.comment,
+                  _dialect_options(table))]
+        for column in table.columns:
+            computed = getattr(column, 'computed', None)
+            parts.append((
+                column.name, repr(column.type), column.nullable,
+                column.primary_key, column.autoincrement, column.comment,
+                _server_default_options(column.server_default),
+                _server_default_options(column.server_onupdate),
+                computed and (str(computed.sqltext), computed.persisted),
+                _generator_options(column.default),
+                _generator_options(getattr(column, 'identity', None)),
+                sorted(_foreign_key_options(fk)
+                       for fk in column.foreign_keys),
+                _dialect_options(column),
+            ))
+        parts.extend(sorted(
+            repr((type(constraint).__name__, constraint.name,
+                  [c.name for c in constraint.columns],
+                  str(getattr(constraint, 'sqltext', '')),
+                  _dialect_options(constraint)))
+            for constraint in table.constraints
+        ))
+        parts.extend(sorted(
+            repr((index.name, index.unique,
+                  [str(e) for e in index.expressions],
+                  _dialect_options(index)))
+            for index in table.indexes
+        ))
+        hash_.update(repr(parts).encode())
+    return hash_.hexdigest()
+
+
+def _dialect_options(item) -> typing.List[typing.Tuple[str, str]]:
+    # e.g. postgresql_using, mysql_engine
+    return sorted((key, repr(value))
+                  for key, value in item.dialect_kwargs.items())
+
+
+def _server_default_options(default) -> typing.Optional[tuple]:
+    # DefaultClause, or FetchedValue which has no SQL
+    if default is None:
+        return None
+    return type(default).__name__, str(getattr(default, 'arg', ''))
+
+
+def _foreign_key_options(foreign_key) -> tuple:
+    return tuple(
+        repr(getattr(foreign_key, name, None))
+        for name in ('target_fullname', 'name', 'ondelete', 'onupdate',
+                     'deferrable', 'initially', 'match', 'use_alter')
+    )
+
+
+def _generator_options(generator) -> typing.Optional[tuple]:
+    # Sequence and Identity
+    if generator is None or not hasattr(generator, 'start'):
+        return None
+    return (type(generator).__name__,) + tuple(
+        repr(getattr(generator, name, None))
+        for name in ('name', 'schema', 'start', 'increment', 'minvalue',
+                     'maxvalue', 'nominvalue', 'nomaxvalue', 'cycle',
+                     'cache', 'order', 'always', 'on_null')
+    )
+
+
+def _replace_database(url, database: str):
+    if hasattr(url, 'set'):
+        return url.set(database=database)
+    # SQLAlchemy < 1.4 has mutable URLs
+    url = copy.copy(url)
+    url.database = database
+    return url
+
+
+def _build_template(metadata: MetaData, engine: Engine) -> str:
+    # Tables can be added to the same metadata later, so the template is
+    # looked up by what the schema is like.
+    fingerprint = _fingerprint_metadata(metadata, engine.dialect.name)
+    key = str(engine.url), fingerprint
+    try:
+        return _templates[key][1]
+    except KeyError:
+        pass
+    database = engine.url.database
+    worker = os.environ.get('PYTEST_XDIST_WORKER')
+    if engine.dialect.name == 'sqlite':
+        if not database or database == ':memory:':
+            raise ValueError(
+                'template databases require a file-based SQLite database'
+            )
+        if worker:
+            database += '.' + worker
+        template = '{!s}.{!s}.template'.format(database, fingerprint[:12])
+        if os.path.exists(template):
+            os.remove(template)
+    elif engine.dialect.name == 'postgresql':
+        template = '{!s}_template_{!s}'.format(database, fingerprint[:12])
+        if worker:
+            template += '_' + worker
+        quoted = engine.dialect.identifier_preparer.quote(template)
+        admin = engine.execution_options(isolation_level='AUTOCOMMIT')
+        with admin.connect() as connection:
+            connection.execute(text('DROP DATABASE IF EXISTS ' + quoted))
+            connection.execute(text('CREATE DATABASE ' + quoted))
+    else:
+        raise ValueError(
+            'template databases are not supported on {!s}'.format(
+                engine.dialect.name
+            )
+        )
+    template_engine = create_engine(_replace_database(engine.url, template))
+    try:
+        metadata.create_all(template_engine)
+    finally:
+        # PostgreSQL refuses to copy a template which has open connections.
+        template_engine.dispose()
+    _templates[key] = engine, template
+    return template
+
+
+@contextlib.contextmanager
+def _clone_database(
+    metadata: MetaData,
+    engine: Engine,
+) -> typing.Generator:
+    template = _build_template(metadata, engine)
+    clone = '{!s}_{!s}'.format(engine.url.database, uuid.uuid4().hex[:12])
+    if engine.dialect.name == 'sqlite':
+        shutil.copyfile(template, clone)
+    else:
+        preparer = engine.dialect.identifier_preparer
+        admin = engine.execution_options(isolation_level='AUTOCOMMIT')
+        with admin.connect() as connection:
+            connection.execute(text(
+                'CREATE DATABASE {!s} TEMPLATE {!s}'.format(
+                    preparer.quote(clone), preparer.quote(template)
+                )
+            ))
+    clone_engine = create_engine(_replace_database(engine.url, clone))
+    try:
+        yield clone_engine
+    finally:
+        clone_engine.dispose()
+        if engine.dialect.name == 'sqlite':
+            os.remove(clone)
+        else:
+            with admin.connect() as connection:
+                connection.execute(
+                    text('DROP DATABASE ' + preparer.quote(clone))
+                )
+
+
+def _worker_schema() -> str:
+    return '"ormeasy_{!s}"'.format(os.environ['PYTEST_XDIST_WORKER'])
+
+
+def _execute_in_autocommit(dbapi_connection, statements) -> None:
+    # SET would be reverted by the rollback when the connection is returned
+    # to the pool, so it has to be run outside of transactions.
+    autocommit = dbapi_connection.autocommit
+    dbapi_connection.autocommit = True
+    cursor = dbapi_connection.cursor()
+    try:
+        for statement in statements:
+            cursor.execute(statement)
+    finally:
+        cursor.close()
+    dbapi_connection.autocommit = autocommit
+
+
+def _set_worker_search_path(dbapi_connection, connection_record) -> None:
+    schema = _worker_schema()
+    _execute_in_autocommit(dbapi_connection, [
+        'CREATE SCHEMA IF NOT EXISTS ' + schema,
+        # public still has to be searched for extensions installed there
+        # (e.g. citext, hstore)
+        'SET SESSION search_path TO ' + schema + ', public',
+    ])
+
+
+def _reset_worker_search_path(dbapi_connection, connection_record,
+                              connection_proxy) -> None:
+    # DISCARD ALL or RESET ALL (e.g. by reset_connection of test_connection)
+    # reverts search_path, so it's set again whenever the connection is
+    # checked out.
+    _execute_in_autocommit(dbapi_connection, [
+        'SET SESSION search_path TO ' + _worker_schema() + ', public',
+    ])
+
+
+def _redirect_worker_database(dialect, connection_record, cargs,
+                              cparams) -> None:
+    # pysqlite and aiosqlite take the database file as the first argument.
+    # cargs is shared by all connections of the engine, so it's redirected
+    # only once.
+    filename, sep, query = cargs[0], '', ''
+    if cparams.get('uri'):
+        filename, sep, query = filename.partition('?')
+    suffix = '.' + os.environ['PYTEST_XDIST_WORKER']
+    if not filename.endswith(suffix):
+        cargs[0] = filename + suffix + sep + query
+
+
+def _worker_listeners(
+    engine: Engine,
+) -> typing.List[typing.Tuple[str, typing.Callable, typing.Dict]]:
+    # The identifiers, the listeners and the options of listen()
+    if engine.dialect.name == 'postgresql':
+        return [('connect', _set_worker_search_path, {'insert': True}),
+                ('checkout', _reset_worker_search_path, {'insert': True})]
+    elif engine.dialect.name != 'sqlite':
+        warnings.warn(
+            'cannot isolate pytest-xdist workers on {!s}'.format(
+                engine.dialect.name
+            ),
+            RuntimeWarning
+        )
+        return []
+    database = engine.url.database
+    if not database or database == ':memory:' or \
+       engine.url.query.get('mode') == 'memory':
+        # In-memory databases are private to the worker process anyway.
+        return []
+    # a dialect event, which can't be inserted first
+    return [('do_connect', _redirect_worker_database, {})]
+
+
+def _listen_worker(engine: Engine) -> bool:
+    # The engine is isolated in place by listeners, so that the options and
+    # listeners given by the caller are kept.  Returns whether a listener
+    # was added.
+    added = False
+    for identifier, listener, options in _worker_listeners(engine):
+        if not contains(engine, identifier, listener):
+            listen(engine, identifier, listener, **options)
+            added = True
+    return added
+
+
+def _isolate_worker(engine: Engine) -> Engine:
+    if not os.environ.get('PYTEST_XDIST_WORKER'):
+        return engine
+    if _listen_worker(engine):
+        # Connections already in the pool aren't isolated.
+        engine.dispose()
+    return engine
+
+
+#: The metadata whose schema was created with ``truncate`` per engine.
+_prepared_schemas = weakref.WeakKeyDictionary()
+
+
+def _prepare_schema(metadata: MetaData, engine: Engine) -> bool:
+    # Whether the schema has to be created (only once per engine).
+    prepared = _prepared_schemas.setdefault(engine, weakref.WeakSet())
+    if metadata in prepared:
+        return False
+    prepared.add(metadata)
+    return True
+
+
+@contextlib.contextmanager
+def _track_written_tables(
+    metadata: MetaData,
+    engine: Engine,
+) -> typing.Generator:
+    tables = set(metadata.tables.values())
+    written = set()
+
+    def track(conn, cursor, statement, parameters, context, executemany):
+        compiled = getattr(context, 'compiled', None)
+        if compiled is None or not (context.isinsert or context.isupdate or
+                                    context.isdelete):
+            return
+        table = getattr(compiled.statement, 'table', None)
+        if table in tables:
+            written.add(table)
+
+    listen(engine, 'after_cursor_execute', track)
+    try:
+        yield written
+    finally:
+        remove(engine, 'after_cursor_execute', track)
+
+
+def _truncate_tables(
+    connection: Connection,
+    metadata: MetaData,
+    tables: typing.Iterable,
+) -> None:
+    tables = set(tables)
+    # dependent tables first
+    tables = [t for t in reversed(metadata.sorted_tables) if t in tables]
+    if not tables:
+        return
+    if connection.dialect.name == 'postgresql':
+        preparer = connection.dialect.identifier_preparer
+        connection.execute(text(
+            'TRUNCATE {!s} RESTART IDENTITY CASCADE'.format(
+                ', '.join(preparer.format_table(t) for t in tables)
+            )
+        ))
+    else:
+        for table in tables:
+            connection.execute(table.delete())
+
+
+def _engine_options(
+    config: typing.Union[str, URL, typing.Mapping[str, typing.Any]],
+    prefix: str,
+    concurrency: typing.Optional[int],
+    pool_class: type,
+) -> typing.Tuple[URL, typing.Dict[str, typing.Any]]:
+    if isinstance(config, collections.abc.Mapping):
+        url = make_url(config[prefix + 'url'])
+        configured = {key[len(prefix):] for key in config
+                      if key.startswith(prefix)}
+    else:
+        url = make_url(config)
+        configured = set()
+    if url.get_backend_name() == 'sqlite' and (
+        not url.database or url.database == ':memory:' or
+        url.query.get('mode') == 'memory'
+    ):
+        return url, {}
+    pool_size = concurrency or DEFAULT_CONCURRENCY
+    options = {
+        'poolclass': pool_class,
+        'pool_size': pool_size,
+        'max_overflow': pool_size // 2,
+        'pool_pre_ping': True,
+        'pool_recycle': POOL_RECYCLE,
+        'pool_timeout': POOL_TIMEOUT,
+        'pool_use_lifo': True,
+    }
+    for key in configured:
+        options.pop(key, None)
+    return url, options
+
+
+class _PoolCounters:
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.connects = 0
+        self.timeouts = 0
+        self.peak_overflow = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+
+class _MeasuredPoolMixin:
+    """Counts checkouts of the pool.  :meth:`connect` is measured instead of
+    :meth:`_do_get`, which calls itself while waiting.
+
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.counters = _PoolCounters()
+
+    def recreate(self):
+        # Engine.dispose() replaces the pool with a recreated one.
+        pool = super().recreate()
+        pool.counters = self.counters
+        return pool
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except PoolTimeoutError:
+            with self.counters.lock:
+                self.counters.timeouts += 1
+            raise
+        elapsed = time.perf_counter() - start
+        counters = self.counters
+        with counters.lock:
+            counters.checkouts += 1
+            counters.wait_time += elapsed
+            counters.max_wait_time = max(counters.max_wait_time, elapsed)
+            counters.peak_overflow = max(counters.peak_overflow,
+                                         self.overflow())
+        return connection
+
+    def _create_connection(self):
+        connection = super()._create_connection()
+        with self.counters.lock:
+            self.counters.connects += 1
+        return connection
+
+
+class _MeasuredQueuePool(_MeasuredPoolMixin, QueuePool):
+    pass
+
+
+_fingerprint_patterns = [
+    # string literals
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    # numbers which are not parts of identifiers
+    (re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?\b'), '?'),
+    # bind parameters: %(name)s, %s, :name, $1
+    (re.compile(r'%\(\w+\)s|%s|(?<!:):\w+|\$\d+'), '?'),
+    # IN lists of any length
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(?)'),
+    (re.compile(r'\s+'), ' '),
+]
+
+
+def _fingerprint_statement(statement: str) -> str:
+    for pattern, replacement in _fingerprint_patterns:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+def _warm_statement_cache(
+    engine: Engine,
+    metadata: typing.Optional[MetaData],
+    statements: typing.Iterable[HotStatement],
+    crud: bool,
+) -> int:
+    cache = engine._compiled_cache
+    if cache is None:
+        return 0
+    dialect = engine.dialect
+    hot_statements = list(_hot_statements)
+    hot_statements.extend(statements)
+    if crud and metadata is not None:
+        for table in metadata.sorted_tables:
+            hot_statements.extend(_crud_statements(table))
+    size = len(cache)
+    for statement in hot_statements:
+        if isinstance(statement, tuple):
+            statement, parameters = statement
+        else:
+            parameters = {}
+        if isinstance(parameters, collections.abc.Mapping):
+            parameters = [parameters]
+        statement._compile_w_cache(
+            dialect=dialect,
+            compiled_cache=cache,
+            column_keys=sorted(parameters[0]) if parameters else [],
+            for_executemany=len(parameters) > 1,
+            schema_translate_map=None,
+            linting=dialect.compiler_linting | compiler.WARN_LINTING,
+        )
+    return len(cache) - size
+
+
+def _crud_statements(table) -> typing.List[HotStatement]:
+    columns = {column.key: None for column in table.columns}
+    statements = [
+        (table.insert(), columns),
+        (table.insert(), [columns, columns]),
+    ]
+    primary_key = list(table.primary_key)
+    if not primary_key:
+        return statements
+    # Literals in the criteria do not make a difference to the cache key.
+    criteria = and_(*(
+        column == bindparam(None, None, type_=column.type, unique=True,
+                            required=False)
+        for column in primary_key
+    ))
+    values = {key: None for key in columns
+              if key not in table.primary_key.columns}
+    statements.extend([
+        table.select().where(criteria),
+        table.delete().where(criteria),
+    ])
+    if values:
+        statements.append((table.update().where(criteria), values))
+    return statements
+
+
+def _sync_engine(engine) -> Engine:
+    return getattr(engine, 'sync_engine', engine)
+
+
+def _is_read(clause) -> bool:
+    return clause is not None and getattr(clause, 'is_select', False) and \
+        getattr(clause, '_for_update_arg', None) is None
+
+
+def _replication_lag(connection: Connection) -> typing.Optional[float]:
+    if connection.dialect.name != 'postgresql':
+        connection.execute(text('SELECT 1'))
+        return None
+    lag = connection.execute(text(
+        'SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())'
+    )).scalar()
+    return None if lag is None else float(lag)
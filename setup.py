@@ -28,9 +28,10 @@ def get_version():
             raise ValueError('could not find __version_info__')
 
 
-tests_require = ['pytest', 'import-order', 'flake8']
+tests_require = ['pytest', 'import-order', 'flake8', 'aiosqlite', 'greenlet']
 install_requires = ['alembic', 'sqlalchemy']
 docs_require = ['Sphinx']
+yaml_require = ['PyYAML']
 
 
 setup(
@@ -46,6 +47,7 @@ setup(
     extras_require={
         'tests': tests_require,
         'docs': docs_require,
+        'yaml': yaml_require,
     },
     tests_require=tests_require,
     classifiers=[
@@ -0,0 +1,315 @@
+import json
+
+from alembic.config import Config
+from alembic.migration import MigrationContext
+from pytest import fixture, raises
+from sqlalchemy import (Column, Computed, FetchedValue, ForeignKey, Identity,
+                        Index, Integer, MetaData, Sequence, Table, Unicode,
+                        create_engine, func, inspect, select)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import make_url
+
+from ormeasy.alembic import (_StatementBuffer, _compile_ddl, _execute_script,
+                             _fingerprint_metadata, _script_directory,
+                             check_schema, upgrade_database,
+                             upgrade_databases)
+
+ENV_PY = '''
+from alembic import context
+from sqlalchemy import create_engine
+
+config = context.config
+if context.is_offline_mode():
+    context.configure(dialect_name=config.attributes['dialect_name'],
+                      literal_binds=True)
+    with context.begin_transaction():
+        context.run_migrations()
+elif config.attributes.get('connection') is not None:
+    context.configure(connection=config.attributes['connection'])
+    with context.begin_transaction():
+        context.run_migrations()
+else:
+    engine = create_engine(config.get_main_option('sqlalchemy.url'))
+    with engine.connect() as connection:
+        context.configure(connection=connection)
+        with context.begin_transaction():
+            context.run_migrations()
+    engine.dispose()
+'''
+
+REVISION_PY = '''
+from alembic import op
+import sqlalchemy as sa
+
+revision = {revision!r}
+down_revision = {down_revision!r}
+
+
+def upgrade():
+    op.create_table({table!r}, sa.Column('id', sa.Integer, primary_key=True))
+
+
+def downgrade():
+    op.drop_table({table!r})
+'''
+
+
+@fixture
+def fx_config(tmpdir):
+    script_dir = tmpdir.mkdir('migrations')
+    script_dir.join('env.py').write(ENV_PY)
+    versions = script_dir.mkdir('versions')
+    for revision, down_revision, table in [('r1', None, 'song'),
+                                           ('r2', 'r1', 'album')]:
+        versions.join(revision + '.py').write(REVISION_PY.format(
+            revision=revision, down_revision=down_revision, table=table
+        ))
+    config = Config()
+    config.set_main_option('script_location', str(script_dir))
+    config.set_main_option('sqlalchemy.url',
+                           'sqlite:///' + str(tmpdir.join('test.db')))
+    return config
+
+
+@fixture
+def fx_engine(fx_config):
+    engine = create_engine(fx_config.get_main_option('sqlalchemy.url'))
+    yield engine
+    engine.dispose()
+
+
+def current_revision(engine):
+    with engine.connect() as connection:
+        return MigrationContext.configure(connection).get_current_revision()
+
+
+def test_upgrade_database_offline(fx_config, fx_engine):
+    upgrade_database(fx_config, fx_engine, MetaData(), revision='r1')
+    assert current_revision(fx_engine) == 'r1'
+    with raises(ValueError):
+        upgrade_database(fx_config, fx_engine, MetaData(), offline=True,
+                         on_step=print)
+    assert current_revision(fx_engine) == 'r1'
+    upgrade_database(fx_config, fx_engine, MetaData(), offline=True)
+    assert current_revision(fx_engine) == 'r2'
+    assert inspect(fx_engine).has_table('song')
+    assert inspect(fx_engine).has_table('album')
+
+
+def test_statement_buffer():
+    buffer = _StatementBuffer()
+    for text in ['-- Running upgrade r1 -> r2\n\n', 'BEGIN;\n\n',
+                 '-- backfill the new column\nUPDATE song SET x = 1;\n\n',
+                 'COMMIT;\n\n']:
+        buffer.write(text)
+    assert buffer.statements == [
+        '-- backfill the new column\nUPDATE song SET x = 1;',
+    ]
+
+
+def test_upgrade_database_offline_changed_script(fx_config, tmpdir):
+    engines = [
+        create_engine('sqlite:///' + str(tmpdir.join(name + '.db')))
+        for name in ('first', 'second')
+    ]
+    upgrade_databases(fx_config, engines, MetaData(), revision='r1')
+    upgrade_database(fx_config, engines[0], MetaData(), offline=True)
+    tmpdir.join('migrations', 'versions', 'r2.py').write(REVISION_PY.format(
+        revision='r2', down_revision='r1', table='album_renamed'
+    ))
+    upgrade_database(fx_config, engines[1], MetaData(), offline=True)
+    assert inspect(engines[0]).has_table('album')
+    assert inspect(engines[1]).has_table('album_renamed')
+    assert not inspect(engines[1]).has_table('album')
+    for engine in engines:
+        engine.dispose()
+
+
+def test_upgrade_database_ddl_snapshot(fx_config, fx_engine, tmpdir,
+                                       monkeypatch):
+    metadata = MetaData()
+    Table('song', metadata, Column('id', Integer, primary_key=True),
+          Column('note', Unicode, server_default='a;\n\nb'))
+    Table('album', metadata, Column('id', Integer, primary_key=True),
+          Column('title', Unicode, index=True))
+    cache_dir = tmpdir.join('ddl')
+    upgrade_database(fx_config, fx_engine, metadata,
+                     ddl_cache_dir=str(cache_dir))
+    assert current_revision(fx_engine) == 'r2'
+    assert inspect(fx_engine).has_table('song')
+    assert inspect(fx_engine).has_table('album')
+    snapshot, = cache_dir.listdir()
+    assert snapshot.ext == '.json'
+    assert any('CREATE INDEX' in s for s in json.loads(snapshot.read()))
+    # as another process would, read the DDL from the cache directory
+    monkeypatch.setattr('ormeasy.alembic._ddl_snapshots', {})
+    engine = create_engine('sqlite:///' + str(tmpdir.join('cached.db')))
+    result, = upgrade_databases(fx_config, [engine], metadata,
+                                ddl_cache_dir=str(cache_dir))
+    assert result.error is None
+    with engine.begin() as connection:
+        connection.execute(metadata.tables['song'].insert(), {'id': 1})
+        assert connection.execute(
+            select(metadata.tables['song'].c.note)
+        ).scalar() == 'a;\n\nb'
+    engine.dispose()
+
+
+def test_compile_ddl_script(monkeypatch):
+    monkeypatch.setattr('ormeasy.alembic._ddl_snapshots', {})
+    metadata = MetaData()
+    Table('song', metadata, Column('id', Integer, primary_key=True),
+          Column('note', Unicode, server_default='a;\n\nb'))
+    Table('album', metadata, Column('id', Integer, primary_key=True),
+          Column('title', Unicode, index=True))
+
+    class Engine:
+        # as connected to a server, without a DB-API driver installed
+        url = make_url('postgresql://')
+        dialect = postgresql.dialect()
+        dialect.server_version_info = (13, 0)
+    engine = Engine()
+    statements = _compile_ddl(metadata, engine)
+    assert len(statements) == 3
+    assert all(s.endswith(';') for s in statements)
+    assert _compile_ddl(metadata, engine) is statements
+    # compiled again for another server version
+    engine.dialect.server_version_info = (9, 6)
+    assert _compile_ddl(metadata, engine) is not statements
+
+    class Connection:
+        dialect = engine.dialect
+        scripts = []
+
+        def execute(self, sql):
+            self.scripts.append(sql)
+
+        exec_driver_sql = execute
+    _execute_script(Connection(), statements)
+    assert Connection.scripts == ['\n'.join(statements)]
+    assert Connection.scripts[0].count(';\nCREATE') == 2
+
+
+def test_fingerprint_metadata():
+    def fingerprint(*args, **kwargs):
+        metadata = MetaData()
+        table = Table('song', metadata,
+                      Column('id', Integer, *args, primary_key=True),
+                      Column('title', Unicode, comment=kwargs.get('comment')),
+                      *kwargs.get('columns', ()),
+                      **kwargs.get('table', {}))
+        if kwargs.get('index') is not None:
+            Index('ix_title', kwargs['index'](table.c.title),
+                  **kwargs.get('index_options', {}))
+        return _fingerprint_metadata(metadata, 'postgresql')
+    fingerprints = [
+        fingerprint(),
+        fingerprint(comment='title'),
+        fingerprint(Sequence('song_id_seq')),
+        fingerprint(Sequence('song_id_seq', start=100)),
+        fingerprint(table={'mysql_engine': 'InnoDB'}),
+        fingerprint(index=func.lower),
+        fingerprint(index=func.upper),
+        fingerprint(index=func.lower,
+                    index_options={'postgresql_using': 'gin'}),
+        fingerprint(columns=[Column('song_id', ForeignKey('song.id'))]),
+        fingerprint(columns=[
+            Column('song_id', ForeignKey('song.id', ondelete='CASCADE'))
+        ]),
+        fingerprint(columns=[
+            Column('song_id', ForeignKey('song.id', deferrable=True))
+        ]),
+        fingerprint(columns=[Column('n', Integer, Computed('id + 1'))]),
+        fingerprint(columns=[Column('n', Integer, Computed('id * 2'))]),
+        fingerprint(columns=[Column('n', Integer, Computed('id * 2',
+                                                           persisted=True))]),
+        fingerprint(columns=[Column('n', Integer,
+                                    server_onupdate=FetchedValue())]),
+        fingerprint(columns=[Column('n', Integer, Identity(start=1))]),
+        fingerprint(columns=[Column('n', Integer, Identity(start=2))]),
+    ]
+    assert len(set(fingerprints)) == len(fingerprints)
+    assert fingerprint(index=func.lower) == fingerprints[5]
+
+
+def test_upgrade_databases(fx_config, fx_engine, tmpdir):
+    upgrade_database(fx_config, fx_engine, MetaData(), revision='r1')
+    engines = [fx_engine] + [
+        create_engine('sqlite:///' + str(tmpdir.join('tenant{}.db'.format(i))))
+        for i in range(3)
+    ]
+    done = []
+    results = upgrade_databases(fx_config, engines, MetaData(),
+                                max_workers=2, progress=done.append)
+    assert sorted(done, key=lambda r: engines.index(r.engine)) == results
+    assert [(r.engine, r.before, r.after, r.error) for r in results] == [
+        (fx_engine, 'r1', 'r2', None),
+    ] + [(engine, None, 'r2', None) for engine in engines[1:]]
+    assert all(current_revision(engine) == 'r2' for engine in engines)
+    results = upgrade_databases(fx_config, engines, MetaData())
+    assert all(r.before == r.after == 'r2' for r in results)
+
+
+def test_upgrade_databases_future_engine(fx_config, tmpdir):
+    url = 'sqlite:///' + str(tmpdir.join('future.db'))
+    engine = create_engine(url, future=True)
+    result, = upgrade_databases(fx_config, [engine], MetaData(),
+                                revision='r2')
+    engine.dispose()
+    assert (result.before, result.after, result.error) == (None, 'r2', None)
+    engine = create_engine(url)
+    assert current_revision(engine) == 'r2'
+    assert inspect(engine).has_table('album')
+    engine.dispose()
+
+
+def test_script_directory_cache(fx_config, tmpdir):
+    script = _script_directory(fx_config)
+    assert _script_directory(fx_config) is script
+    revision = tmpdir.join('migrations', 'versions', 'r2.py')
+    revision.setmtime(revision.mtime() + 10)
+    assert _script_directory(fx_config) is not script
+
+
+def test_upgrade_database_on_step(fx_config, fx_engine):
+    steps = []
+    upgrade_database(fx_config, fx_engine, MetaData(), revision='r1')
+    upgrade_database(fx_config, fx_engine, MetaData(), on_step=steps.append)
+    step, = steps
+    assert (step.source, step.destination) == (('r1',), ('r2',))
+    assert step.elapsed >= step.database_time > 0
+    assert step.statements[0].startswith('\nCREATE TABLE album')
+    assert step.statements[-1].startswith('UPDATE alembic_version')
+    with raises(ValueError):
+        upgrade_database(fx_config, fx_engine, MetaData(), lock_timeout=100)
+    with raises(ValueError):
+        upgrade_database(fx_config, fx_engine, MetaData(), offline=True,
+                         statement_timeout=100)
+
+
+def test_check_schema(fx_config, fx_engine):
+    metadata = MetaData()
+    Table('song', metadata, Column('id', Integer, primary_key=True))
+    Table('album', metadata, Column('id', Integer, primary_key=True),
+          Column('title', Unicode))
+    drift = check_schema(fx_config, fx_engine, metadata)
+    assert drift.drifted
+    assert drift.current_heads == ()
+    assert drift.heads == ('r2',)
+    assert drift.missing_tables == ('album', 'song')
+    upgrade_database(fx_config, fx_engine, MetaData(), revision='r2')
+    with fx_engine.begin() as connection:
+        connection.exec_driver_sql('CREATE TABLE extra (id INTEGER)')
+        connection.exec_driver_sql('CREATE VIEW song_view AS SELECT * '
+                                   'FROM song')
+    drift = check_schema(fx_config, fx_engine, metadata)
+    assert drift.drifted
+    assert drift.current_heads == drift.heads == ('r2',)
+    assert drift.missing_tables == ()
+    assert drift.unexpected_tables == ('extra',)
+    assert drift.missing_columns == (('album', 'title'),)
+    assert drift.unexpected_columns == ()
+    Table('extra', metadata, Column('id', Integer))
+    with fx_engine.begin() as connection:
+        connection.exec_driver_sql('ALTER TABLE album ADD title TEXT')
+    assert not check_schema(fx_config, fx_engine, metadata).drifted
@@ -0,0 +1,288 @@
+import asyncio
+
+from pytest import raises
+from sqlalchemy import (Column, ForeignKey, Integer, MetaData, Table,
+                        create_engine, event, inspect, select, text)
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from ormeasy.asyncsqlalchemy import (build_async_engine, check_replicas,
+                                     check_schema, nested_test_connection,
+                                     routing_session, session_test_schema,
+                                     upgrade_database, upgrade_databases)
+from ormeasy.asyncsqlalchemy import test_connection as _test_connection
+from ormeasy.sqlalchemy import Router, pool_statistics, profile_queries
+from .alembic_test import current_revision, fx_config, fx_engine  # noqa
+from .sqlalchemy_test import Context
+
+
+def test_upgrade_database(fx_config, fx_engine):  # noqa
+    async def upgrade():
+        engine = create_async_engine(
+            str(fx_engine.url).replace('sqlite:', 'sqlite+aiosqlite:')
+        )
+        await upgrade_database(fx_config, engine, MetaData(), revision='r1')
+        await engine.dispose()
+    asyncio.run(upgrade())
+    assert current_revision(fx_engine) == 'r1'
+
+
+def test_upgrade_databases(fx_config, tmpdir):  # noqa
+    async def upgrade():
+        engines = [
+            create_async_engine('sqlite+aiosqlite:///' +
+                                str(tmpdir.join('tenant{}.db'.format(i))))
+            for i in range(3)
+        ]
+        results = await upgrade_databases(fx_config, engines, MetaData())
+        for engine in engines:
+            await engine.dispose()
+        return results
+    results = asyncio.run(upgrade())
+    assert [(r.before, r.after, r.error) for r in results] == [
+        (None, 'r2', None),
+    ] * 3
+    for i in range(3):
+        engine = create_engine('sqlite:///' +
+                               str(tmpdir.join('tenant{}.db'.format(i))))
+        assert current_revision(engine) == 'r2'
+        engine.dispose()
+
+
+def test_upgrade_databases_stop_on_error(fx_config, tmpdir):  # noqa
+    async def upgrade():
+        engines = [
+            create_async_engine('sqlite+aiosqlite:///' +
+                                str(tmpdir.join('no', 'dir.db'))),
+        ] + [
+            create_async_engine('sqlite+aiosqlite:///' +
+                                str(tmpdir.join('tenant{}.db'.format(i))))
+            for i in range(3)
+        ]
+        done = []
+        with raises(Exception):
+            await upgrade_databases(fx_config, engines, MetaData(),
+                                    stop_on_error=True, progress=done.append)
+        reported = list(done)
+        # nothing goes on after the error is raised
+        await asyncio.sleep(0.5)
+        for engine in engines:
+            await engine.dispose()
+        return reported, done
+    reported, done = asyncio.run(upgrade())
+    assert done == reported
+    assert done[-1].error is not None
+
+
+def test_nested_test_connection(tmpdir):
+    metadata = MetaData()
+    table = Table('item', metadata, Column('id', Integer, primary_key=True))
+
+    async def write(engine, ctx):
+        async with nested_test_connection(ctx, engine) as connection:
+            async with AsyncSession(bind=connection) as session:
+                await session.execute(table.insert(), [{'id': 1}])
+                await session.commit()
+                await session.execute(table.insert(), [{'id': 2}])
+                await session.commit()
+            assert ctx._test_fx_connection is connection
+            result = await connection.execute(table.select())
+            return [row.id for row in result]
+
+    async def read(engine, ctx):
+        async with nested_test_connection(ctx, engine) as connection:
+            result = await connection.execute(table.select())
+            return [row.id for row in result]
+
+    async def run():
+        engine = create_async_engine(
+            'sqlite+aiosqlite:///' + str(tmpdir.join('db.sqlite'))
+        )
+
+        # pysqlite does not emit BEGIN itself, which breaks SAVEPOINT
+        @event.listens_for(engine.sync_engine, 'connect')
+        def connect(dbapi_connection, record):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine.sync_engine, 'begin')
+        def begin(connection):
+            connection.exec_driver_sql('BEGIN')
+
+        async with session_test_schema(metadata, engine) as test_engine:
+            written, read_ = await asyncio.gather(
+                write(test_engine, Context()),
+                read(test_engine, Context()),
+            )
+            async with test_engine.connect() as connection:
+                result = await connection.execute(
+                    text('SELECT count(*) FROM item')
+                )
+                count = result.scalar()
+        return written, read_, count
+
+    written, read_, count = asyncio.run(run())
+    assert written == [1, 2]
+    assert read_ == []
+    assert count == 0
+
+
+def test_connection_xdist_worker(monkeypatch, tmpdir):
+    metadata = MetaData()
+    Table('song', metadata, Column('id', Integer, primary_key=True))
+    monkeypatch.setenv('PYTEST_XDIST_WORKER', 'gw1')
+
+    connects = []
+
+    async def run():
+        engine = create_async_engine(
+            'sqlite+aiosqlite:///' + str(tmpdir.join('test.db'))
+        )
+        event.listen(engine.sync_engine, 'connect',
+                     lambda *args: connects.append(args))
+        async with _test_connection(Context(), metadata, engine,
+                                    real_transaction=True) as connection:
+            tables = await connection.run_sync(
+                lambda conn: inspect(conn).get_table_names()
+            )
+        return tables
+    assert asyncio.run(run()) == ['song']
+    assert connects
+    assert tmpdir.listdir() == [tmpdir.join('test.db.gw1')]
+
+
+def test_connection_truncate(tmpdir):
+    metadata = MetaData()
+    artist = Table('artist', metadata,
+                   Column('id', Integer, primary_key=True))
+    song = Table('song', metadata,
+                 Column('id', Integer, primary_key=True),
+                 Column('artist_id', Integer, ForeignKey(artist.c.id)))
+    Table('album', metadata, Column('id', Integer, primary_key=True))
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    async def run():
+        engine = create_async_engine(
+            'sqlite+aiosqlite:///' + str(tmpdir.join('test.db'))
+        )
+        # a stale table left by a previous run
+        stale = MetaData()
+        Table('song', stale, Column('id', Integer, primary_key=True))
+        async with engine.begin() as connection:
+            await connection.run_sync(stale.create_all)
+        event.listen(engine.sync_engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        rows = []
+        for _ in range(2):
+            async with _test_connection(Context(), metadata, engine,
+                                        real_transaction=True,
+                                        truncate=True) as connection:
+                del statements[:]
+                result = await connection.execute(song.select())
+                rows.append(result.fetchall())
+                await connection.execute(artist.insert(), [{'id': 1}])
+                await connection.execute(song.insert(),
+                                         [{'id': 1, 'artist_id': 1}])
+                await connection.commit()
+        with raises(ValueError):
+            async with _test_connection(Context(), metadata, engine,
+                                        truncate=True):
+                pass
+        await engine.dispose()
+        return rows
+    assert asyncio.run(run()) == [[], []]
+    assert [s for s in statements if s.startswith('DELETE')] == [
+        'DELETE FROM song', 'DELETE FROM artist',
+    ]
+
+
+def test_build_async_engine(tmpdir):
+    async def run():
+        engine = build_async_engine(
+            'sqlite+aiosqlite:///' + str(tmpdir.join('test.db')),
+            concurrency=2
+        )
+        async with engine.connect() as connection:
+            await connection.execute(text('SELECT 1'))
+        stats = pool_statistics(engine)
+        await engine.dispose()
+        return stats
+    stats = asyncio.run(run())
+    assert stats.size == 2
+    assert stats.checkouts == 1
+
+
+def test_profile_queries():
+    async def run():
+        engine = create_async_engine('sqlite+aiosqlite://')
+        with profile_queries(engine) as profile:
+            async with engine.connect() as connection:
+                await connection.execute(text('SELECT 1'))
+        await engine.dispose()
+        return profile
+    profile = asyncio.run(run())
+    assert [r.fingerprint for r in profile.records] == ['SELECT ?']
+
+
+def test_profile_queries_connection(tmpdir):
+    async def run():
+        engine = create_async_engine(
+            'sqlite+aiosqlite:///' + str(tmpdir.join('test.db'))
+        )
+        async with engine.connect() as connection, \
+                engine.connect() as other:
+            with profile_queries(connection) as profile:
+                await connection.execute(text('SELECT 1'))
+                await other.execute(text('SELECT 42'))
+        await engine.dispose()
+        return profile
+    profile = asyncio.run(run())
+    assert [r.fingerprint for r in profile.records] == ['SELECT ?']
+
+
+def test_routing_session(tmpdir):
+    metadata = MetaData()
+    song = Table('song', metadata, Column('id', Integer, primary_key=True))
+
+    async def run():
+        primary, replica, broken = [
+            create_async_engine('sqlite+aiosqlite:///' + str(path))
+            for path in (tmpdir.join('primary.db'), tmpdir.join('replica.db'),
+                         tmpdir.join('no', 'dir.db'))
+        ]
+        for engine in primary, replica:
+            async with engine.begin() as connection:
+                await connection.run_sync(metadata.create_all)
+        router = Router(primary, [replica, broken])
+        await check_replicas(router)
+        assert router.unhealthy == {broken}
+        async with routing_session(router) as session:
+            await session.execute(song.insert(), [{'id': 1}])
+            written = (await session.execute(select(song))).fetchall()
+            await session.commit()
+            read = (await session.execute(select(song))).fetchall()
+        for engine in primary, replica, broken:
+            await engine.dispose()
+        return written, read
+    assert asyncio.run(run()) == ([(1,)], [])
+
+
+def test_check_schema(fx_config, fx_engine):  # noqa
+
+    metadata = MetaData()
+    Table('song', metadata, Column('id', Integer, primary_key=True))
+
+    async def check():
+        engine = create_async_engine(
+            str(fx_engine.url).replace('sqlite:', 'sqlite+aiosqlite:')
+        )
+        await upgrade_database(fx_config, engine, MetaData(), revision='r1')
+        drift = await check_schema(fx_config, engine, metadata)
+        await engine.dispose()
+        return drift
+    drift = asyncio.run(check())
+    assert drift.current_heads == ('r1',)
+    assert drift.heads == ('r2',)
+    assert drift.missing_tables == drift.unexpected_tables == ()
+    assert drift.drifted
@@ -1,5 +1,11 @@
+import json
+import sys
+
 from pytest import raises
-from ormeasy.common import get_all_modules
+from ormeasy.common import (INDEX_FILENAME, clear_module_cache,
+                            format_import_profile, get_all_modules,
+                            import_all_modules, import_model_modules,
+                            profile_imports)
 
 
 def test_get_all_modules():
@@ -22,3 +28,97 @@ def test_get_all_sub_modules():
     assert get_all_modules('urllib.error') == {
         'urllib.error',
     }
+
+
+def test_get_all_modules_cache(monkeypatch, tmpdir):
+    package = tmpdir.mkdir('cachedpkg')
+    package.join('__init__.py').write('')
+    package.join('a.py').write('')
+    subpackage = package.mkdir('sub')
+    subpackage.join('__init__.py').write('')
+    subpackage.join('b.py').write('')
+    package.mkdir('assets').join('c.py').write('')
+    path = [str(tmpdir)]
+    monkeypatch.syspath_prepend(str(tmpdir))
+    expected = get_all_modules('cachedpkg', path)
+    assert expected == {'cachedpkg.a', 'cachedpkg.sub', 'cachedpkg.sub.b'}
+    assert get_all_modules('cachedpkg', path, cache=True) == expected
+    assert package.join(INDEX_FILENAME).exists()
+    package.join('assets', '__init__.py').write('')
+    # remembered in the process until the cache is cleared
+    assert get_all_modules('cachedpkg', path, cache=True) == expected
+    clear_module_cache()
+    assert get_all_modules('cachedpkg', path, cache=True) == expected | {
+        'cachedpkg.assets', 'cachedpkg.assets.c',
+    }
+
+
+def test_import_model_modules(monkeypatch, tmpdir):
+    package = tmpdir.mkdir('modelpkg')
+    package.join('__init__.py').write('')
+    package.join('user.py').write(
+        'class User:\n    __tablename__ = "users"\n'
+    )
+    package.join('base.py').write(
+        'from sqlalchemy.orm import declarative_base, declared_attr\n'
+        '\n'
+        '\n'
+        'class Base:\n'
+        '    @declared_attr\n'
+        '    def __tablename__(cls):\n'
+        '        return cls.__name__.lower()\n'
+        '\n'
+        '\n'
+        'Base = declarative_base(cls=Base)\n'
+    )
+    package.join('song.py').write(
+        'from sqlalchemy import Column, Integer\n'
+        'from .base import Base\n'
+        '\n'
+        '\n'
+        'class Song(Base):\n'
+        '    id = Column(Integer, primary_key=True)\n'
+    )
+    package.join('util.py').write('def helper():\n    pass\n')
+    monkeypatch.syspath_prepend(str(tmpdir))
+    try:
+        timings = import_model_modules('modelpkg', [str(tmpdir)])
+        assert sorted(timings) == [
+            'modelpkg.base', 'modelpkg.song', 'modelpkg.user',
+        ]
+        base = sys.modules['modelpkg.base'].Base
+        assert list(base.metadata.tables) == ['song']
+        assert timings['modelpkg.user'] >= 0
+        assert 'modelpkg.user' in sys.modules
+        assert 'modelpkg.util' not in sys.modules
+    finally:
+        for name in list(sys.modules):
+            if name.startswith('modelpkg'):
+                del sys.modules[name]
+
+
+def test_profile_imports(monkeypatch, tmpdir):
+    package = tmpdir.mkdir('profiledpkg')
+    package.join('__init__.py').write('from . import slow\n')
+    package.join('slow.py').write('import time\ntime.sleep(0.01)\n')
+    monkeypatch.syspath_prepend(str(tmpdir))
+    try:
+        with profile_imports(memory=True) as records:
+            import_all_modules('profiledpkg', [str(tmpdir)])
+        records = {record.module: record for record in records}
+        parent = records['profiledpkg']
+        child = records['profiledpkg.slow']
+        assert child.self_time >= 0.01
+        assert parent.total_time >= child.total_time
+        assert parent.self_time < child.self_time
+        assert isinstance(parent.memory, int)
+        assert sys.modules['profiledpkg'].__loader__.name == 'profiledpkg'
+        table = format_import_profile(records.values()).splitlines()
+        assert table[1].endswith('profiledpkg.slow')
+        assert json.loads(
+            format_import_profile(records.values(), 'json', limit=1)
+        )[0]['module'] == 'profiledpkg.slow'
+    finally:
+        for name in list(sys.modules):
+            if name.startswith('profiledpkg'):
+                del sys.modules[name]
@@ -1,4 +1,26 @@
-from ormeasy.sqlalchemy import repr_entity
+import json
+import time
+
+from pytest import mark, raises
+from sqlalchemy import (Column, ForeignKey, Integer, MetaData, Table, Unicode,
+                        create_engine, inspect, literal_column, select)
+from sqlalchemy.event import listen, listens_for
+from sqlalchemy.orm import Session, declarative_base, deferred, relationship
+from sqlalchemy.pool import QueuePool
+
+from ormeasy.sqlalchemy import (Router, RoutingSession, build_engine,
+                                drop_templates, load_fixtures,
+                                nested_test_connection, pool_statistics,
+                                profile_queries, query_budget,
+                                register_statement, repr_entity,
+                                serialize_entities, session_test_connection,
+                                warm_statement_cache)
+# aliased so that pytest doesn't collect it as a test
+from ormeasy.sqlalchemy import test_connection as _test_connection
+
+
+class Context:
+    """Stands for the pytest ``request`` object."""
 
 
 class Music:
@@ -14,3 +36,401 @@ def test_repr_entity():
     repr_ = repr_entity(Music())
     expected = "<tests.sqlalchemy_test.Music name='The box' track_number=6>"
     assert repr_ == expected
+    music = Music()
+    music.__repr_columns__ = 'name',
+    assert repr_entity(music) == "<tests.sqlalchemy_test.Music name='The box'>"
+    assert repr_entity(Music()) == expected
+
+
+def test_connection_use_template(tmpdir):
+    metadata = MetaData()
+    table = Table('song', metadata, Column('id', Integer, primary_key=True))
+    created = []
+    listen(table, 'after_create', lambda *args, **kwargs: created.append(1))
+    engine = create_engine('sqlite:///' + str(tmpdir.join('test.db')))
+
+    ctx = Context()
+    for _ in range(2):
+        with _test_connection(ctx, metadata, engine,
+                              use_template=True) as connection:
+            assert connection.execute(table.select()).fetchall() == []
+            connection.execute(table.insert(), [{'id': 1}])
+    assert created == [1]
+    template, = tmpdir.listdir()
+    assert template.basename.endswith('.template')
+    # a table added to the same metadata needs a new template
+    album = Table('album', metadata, Column('id', Integer, primary_key=True))
+    with _test_connection(ctx, metadata, engine,
+                          use_template=True) as connection:
+        assert connection.execute(album.select()).fetchall() == []
+    assert created == [1, 1]
+    assert len(tmpdir.listdir()) == 2
+    drop_templates()
+    assert tmpdir.listdir() == []
+
+
+@mark.filterwarnings('error::sqlalchemy.exc.SAWarning')
+def test_nested_test_connection():
+    metadata = MetaData()
+    table = Table('song', metadata, Column('id', Integer, primary_key=True))
+
+    ctx = Context()
+    engine = create_engine('sqlite://')
+
+    # pysqlite needs this to make SAVEPOINT work
+    @listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @listens_for(engine, 'begin')
+    def begin(connection):
+        connection.exec_driver_sql('BEGIN')
+
+    with session_test_connection(metadata, engine) as session_connection:
+        for _ in range(2):
+            with nested_test_connection(ctx, session_connection) as connection:
+                assert connection.execute(table.select()).fetchall() == []
+                session = Session(bind=connection)
+                session.execute(table.insert(), [{'id': 1}])
+                session.commit()
+                session.execute(table.insert(), [{'id': 2}])
+                session.commit()
+                assert len(connection.execute(table.select()).fetchall()) == 2
+                session.close()
+            assert not session_connection.in_nested_transaction()
+
+
+def test_connection_xdist_worker(monkeypatch, tmpdir):
+    metadata = MetaData()
+    table = Table('song', metadata, Column('id', Integer, primary_key=True))
+    engine = create_engine('sqlite:///' + str(tmpdir.join('test.db')),
+                           poolclass=QueuePool)
+    connects = []
+    listen(engine, 'connect', lambda *args: connects.append(args))
+    monkeypatch.setenv('PYTEST_XDIST_WORKER', 'gw1')
+    with _test_connection(object(), metadata, engine,
+                          real_transaction=True) as worker_engine:
+        # the options and listeners of the engine are kept
+        assert worker_engine is engine
+        assert isinstance(worker_engine.pool, QueuePool)
+        assert connects
+        assert inspect(worker_engine).has_table('song')
+    assert tmpdir.listdir() == [tmpdir.join('test.db.gw1')]
+    with session_test_connection(metadata, engine) as connection:
+        connection.execute(table.insert(), [{'id': 1}])
+    assert tmpdir.listdir() == [tmpdir.join('test.db.gw1')]
+
+
+def test_repr_entity_mapped():
+    Base = declarative_base()
+
+    class Song(Base):
+
+        __tablename__ = 'song'
+
+        id = Column(Integer, primary_key=True)
+
+        name = Column(Unicode)
+
+    expected = "<tests.sqlalchemy_test.{}.<locals>.Song id=1>".format(
+        test_repr_entity_mapped.__name__
+    )
+    assert repr_entity(Song(id=1, name='hello')) == expected
+    assert repr_entity(Song(id=1)) == expected
+
+
+def test_repr_entity_loaded_only():
+    Base = declarative_base()
+
+    class Artist(Base):
+
+        __tablename__ = 'artist'
+
+        id = Column(Integer, primary_key=True)
+
+    class Song(Base):
+
+        __tablename__ = 'song'
+
+        __repr_columns__ = 'id', 'lyrics', 'artist', 'note'
+
+        id = Column(Integer, primary_key=True)
+
+        lyrics = deferred(Column(Unicode))
+
+        artist_id = Column(Integer, ForeignKey(Artist.id))
+
+        artist = relationship(Artist)
+
+        note = 'x' * 100
+
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add(Song(id=1, lyrics='la', artist=Artist(id=2)))
+        session.commit()
+        song = session.query(Song).one()
+        queries = []
+        listen(engine, 'before_cursor_execute',
+               lambda *args: queries.append(args))
+        expected = (
+            '<{}.{}.<locals>.Song id=1 lyrics=<unloaded> '
+            "artist=<unloaded> note='xxxxx'...>"
+        ).format(__name__, test_repr_entity_loaded_only.__name__)
+        assert repr_entity(song, loaded_only=True, max_length=5) == expected
+        song.note = 'abcd'
+        assert repr_entity(song, loaded_only=True, max_length=5).endswith(
+            " note='abcd'>"
+        )
+        assert not queries
+
+
+def test_serialize_entities():
+    musics = (Music() for _ in range(2))
+    assert list(serialize_entities(musics)) == [
+        "<tests.sqlalchemy_test.Music name='The box' track_number=6>",
+    ] * 2
+    assert [json.loads(line)
+            for line in serialize_entities([Music()], 'json')] == [{
+                '__type__': 'tests.sqlalchemy_test.Music',
+                'name': 'The box',
+                'track_number': 6,
+            }]
+    engine = create_engine('sqlite://')
+    with engine.connect() as connection:
+        rows = connection.execute(select(
+            literal_column('1').label('id'),
+            literal_column("'hello'").label('name'),
+        ))
+        line, = serialize_entities(rows, max_length=4)
+        assert line.endswith(" id=1 name='hell'...>")
+
+
+def test_connection_dispose_engine():
+    engine = create_engine('sqlite://')
+    connects = []
+    listen(engine, 'connect', lambda *args: connects.append(args))
+    resets = []
+
+    ctx = Context()
+    for _ in range(2):
+        with _test_connection(ctx, MetaData(), engine, dispose_engine=False,
+                              reset_connection=resets.append):
+            pass
+    assert len(connects) == 1
+    assert len(resets) == 2
+    with raises(ZeroDivisionError):
+        with _test_connection(ctx, MetaData(), engine, dispose_engine=False,
+                              reset_connection=resets.append):
+            1 / 0
+    assert len(resets) == 3
+
+
+def test_connection_truncate(tmpdir):
+    metadata = MetaData()
+    artist = Table('artist', metadata,
+                   Column('id', Integer, primary_key=True))
+    song = Table('song', metadata,
+                 Column('id', Integer, primary_key=True),
+                 Column('artist_id', Integer, ForeignKey(artist.c.id)))
+    Table('album', metadata, Column('id', Integer, primary_key=True))
+    engine = create_engine('sqlite:///' + str(tmpdir.join('test.db')))
+    # a stale table left by a previous run
+    stale = MetaData()
+    Table('song', stale, Column('id', Integer, primary_key=True))
+    stale.create_all(engine)
+    statements = []
+    listen(engine, 'before_cursor_execute',
+           lambda conn, cursor, statement, *args: statements.append(statement))
+    for _ in range(2):
+        with _test_connection(object(), metadata, engine,
+                              real_transaction=True, truncate=True) as bind:
+            del statements[:]
+            assert bind.execute(song.select()).fetchall() == []
+            bind.execute(artist.insert(), [{'id': 1}])
+            bind.execute(song.insert(), [{'id': 1, 'artist_id': 1}])
+        assert [s for s in statements if s.startswith('DELETE')] == [
+            'DELETE FROM song', 'DELETE FROM artist',
+        ]
+        assert inspect(engine).has_table('song')
+    with raises(ValueError):
+        with _test_connection(object(), metadata, engine, truncate=True):
+            pass
+    with raises(ValueError):
+        with _test_connection(object(), metadata, engine, use_template=True,
+                              real_transaction=True, truncate=True):
+            pass
+
+
+def test_connection_fixtures():
+    metadata = MetaData()
+    artist = Table('artist', metadata,
+                   Column('id', Integer, primary_key=True),
+                   Column('name', Unicode))
+    song = Table('song', metadata,
+                 Column('id', Integer, primary_key=True),
+                 Column('artist_id', Integer, ForeignKey(artist.c.id)))
+    fixtures = {
+        'song': [{'id': 1, 'artist_id': 1}, {'id': 2, 'artist_id': 2}],
+        'artist': [{'id': 1, 'name': 'Oasis'}, {'id': 2}],
+    }
+
+    with _test_connection(Context(), metadata, create_engine('sqlite://'),
+                          fixtures=fixtures) as connection:
+        assert connection.execute(
+            artist.select().order_by(artist.c.id)
+        ).fetchall() == [(1, 'Oasis'), (2, None)]
+        assert len(connection.execute(song.select()).fetchall()) == 2
+        with raises(ValueError):
+            load_fixtures(connection, metadata, {'album': []})
+
+
+def test_build_engine(tmpdir):
+    url = 'sqlite:///' + str(tmpdir.join('test.db'))
+    engine = build_engine(url, concurrency=4)
+    assert isinstance(engine.pool, QueuePool)
+    assert engine.pool.size() == 4
+    with engine.connect() as connection:
+        connection.exec_driver_sql('SELECT 1')
+    with engine.connect(), engine.connect():
+        assert pool_statistics(engine).checked_out == 2
+    engine.dispose()
+    with engine.connect():
+        pass
+    stats = pool_statistics(engine)
+    assert stats.checkouts == 4
+    assert stats.connects == 3
+    assert stats.checked_out == 0
+    assert stats.peak_overflow == 0
+    assert stats.wait_time >= stats.max_wait_time > 0
+    connections = [engine.connect() for _ in range(5)]
+    assert pool_statistics(engine).peak_overflow == 1
+    for connection in connections:
+        connection.close()
+    engine.dispose()
+
+    engine = build_engine({'db.url': url, 'db.pool_size': '2'}, prefix='db.',
+                          pool_recycle=60)
+    assert engine.pool.size() == 2
+    assert engine.pool._recycle == 60
+    assert engine.pool._pre_ping
+    engine.dispose()
+
+    engine = build_engine('sqlite://', concurrency=4)
+    assert not isinstance(engine.pool, QueuePool)
+    with raises(ValueError):
+        pool_statistics(engine)
+
+
+def test_profile_queries():
+    metadata = MetaData()
+    song = Table('song', metadata, Column('id', Integer, primary_key=True))
+
+    with _test_connection(Context(), metadata,
+                          create_engine('sqlite://')) as connection:
+        with profile_queries(connection) as profile:
+            connection.execute(song.insert(), [{'id': 1}, {'id': 2}])
+            for i in range(6):
+                connection.execute(song.select().where(song.c.id == i))
+        assert len(profile) == 7
+        assert profile.records[0].rowcount == 2
+        assert profile.n_plus_one() == [
+            ('SELECT song.id FROM song WHERE song.id = ?', 6),
+        ]
+        assert profile.slow_queries(profile.total_time) == []
+        connection.execute(song.select())
+        assert len(profile) == 7
+        with query_budget(connection, max_queries=1):
+            connection.execute(song.select())
+        with raises(AssertionError) as exc_info:
+            with query_budget(connection, max_queries=3, max_repeats=1):
+                for i in range(2):
+                    connection.execute(song.select().where(song.c.id == i))
+        assert 'executed 2 times; budget is 1' in str(exc_info.value)
+
+
+def test_warm_statement_cache(monkeypatch):
+    monkeypatch.setattr('ormeasy.sqlalchemy._hot_statements', [])
+    metadata = MetaData()
+    song = Table('song', metadata,
+                 Column('id', Integer, primary_key=True),
+                 Column('name', Unicode))
+    recent = register_statement(select(song).order_by(song.c.id.desc()))
+    assert recent is not None
+    engine = create_engine('sqlite://')
+    metadata.create_all(engine)
+    assert warm_statement_cache(
+        engine, metadata, statements=[select(song.c.name)]
+    ) == 7
+    size = len(engine._compiled_cache)
+    with engine.begin() as connection:
+        connection.execute(song.insert(), {'id': 1, 'name': 'Wonderwall'})
+        connection.execute(song.insert(), [{'id': 2, 'name': 'Supersonic'},
+                                           {'id': 3, 'name': 'Whatever'}])
+        connection.execute(song.update().where(song.c.id == 2),
+                           {'name': 'Live Forever'})
+        connection.execute(song.select().where(song.c.id == 1)).fetchall()
+        connection.execute(song.delete().where(song.c.id == 3))
+        connection.execute(recent).fetchall()
+        connection.execute(select(song.c.name)).fetchall()
+    assert len(engine._compiled_cache) == size
+    assert warm_statement_cache(engine, metadata) == 0
+
+
+def test_routing_session(tmpdir):
+    metadata = MetaData()
+    song = Table('song', metadata, Column('id', Integer, primary_key=True))
+    engines = [
+        create_engine('sqlite:///' + str(tmpdir.join(name + '.db')),
+                      poolclass=QueuePool)
+        for name in ('primary', 'replica1', 'replica2')
+    ]
+    for engine in engines:
+        metadata.create_all(engine)
+    primary, replica1, replica2 = engines
+    router = Router(primary, [replica1, replica2])
+    router.check()
+    assert [router.replica() for _ in range(3)] == [
+        replica1, replica2, replica1,
+    ]
+    session = RoutingSession(router=router)
+    assert session.get_bind(clause=select(song)) in (replica1, replica2)
+    session.execute(song.insert(), {'id': 1})
+    # reads its own writes
+    assert session.get_bind(clause=select(song)) is primary
+    assert session.execute(select(song)).fetchall() == [(1,)]
+    session.commit()
+    assert session.get_bind(clause=select(song)) in (replica1, replica2)
+    assert session.execute(select(song)).fetchall() == []
+    assert session.get_bind(clause=select(song).with_for_update()) is primary
+    session.close()
+
+    router = Router(primary, [replica1, replica2],
+                    strategy='least_connections')
+    router.check()
+    with replica1.connect():
+        assert router.replica() is replica2
+    with replica2.connect():
+        assert router.replica() is replica1
+
+    broken = create_engine('sqlite:///' + str(tmpdir.join('no', 'dir.db')))
+
+    def lag(connection):
+        if connection.engine is replica2:
+            raise OSError('timed out')
+        return 10 if connection.engine is replica1 else 0
+    router = Router(primary, [broken, replica1, replica2], max_lag=5, lag=lag)
+    router.check()
+    assert router.replica() is primary
+    assert router.unhealthy == {broken, replica1, replica2}
+    # checked in the background, not by the query
+    router = Router(primary, [broken])
+    router.replica()
+    for _ in range(100):
+        if router.unhealthy:
+            break
+        time.sleep(0.01)
+    assert router.unhealthy == {broken}
+    assert router.replica() is primary
+    with raises(ValueError):
+        Router(primary, [], strategy='random')